@@ -5,22 +5,32 @@ import json
 import logging
 import os.path
 import re
+import shutil
 import sys
+import tempfile
 
 # This must be called early - before the rest of the blueprint library loads.
 logging.basicConfig(format='# [blueprint] %(message)s',
                     level=logging.INFO)
 
+import cache
+import chunks
+import compact
 import git
+import lazy
+import managers
 import rules
 import util
 import walk
 
 
-DEFAULTS = {'io': {'max_content_length': 67108864,
+DEFAULTS = {'files': {'blobs': False},
+            'io': {'max_content_length': 67108864,
                    'server': 'https://devstructure.com'},
             's3': {'region': 'US',
                    'use_https': True},
+            'sources': {'chunks': False,
+                        'compression': 'none'},
             'statsd': {'port': 8125}}
 
 
@@ -55,10 +65,15 @@ class Blueprint(dict):
             commit = git.rev_parse('refs/heads/{0}'.format(name))
             if commit is None:
                 raise NotFoundError(name)
+        data = cache.load(commit)
+        if data is not None:
+            return cls._from_cache(name, commit, data)
         tree = git.tree(commit)
         blob = git.blob(tree, 'blueprint.json')
         content = git.content(blob)
-        return cls(name, commit, **json.loads(content))
+        b = cls(name, commit, **json.loads(content))
+        cache.store(commit, b._to_cache())
+        return b
 
     @classmethod
     def create(cls, name):
@@ -82,6 +97,7 @@ class Blueprint(dict):
             git.git('branch', '-D', name)
         except:
             raise NotFoundError(name)
+        cache.prune()
 
     @classmethod
     def iter(cls):
@@ -95,20 +111,167 @@ class Blueprint(dict):
             yield line.strip()
 
     @classmethod
-    def load(cls, f, name=None):
+    def iter_summaries(cls):
+        """
+        Yield a `dict` describing each blueprint: its name plus the commit,
+        date, and message of its latest revision from a single
+        git-for-each-ref(1) and the resource counts stored in that revision's
+        `summary.json`.  Counts are `None` for revisions committed before
+        summaries were stored.  No blueprint JSON is parsed.
+        """
+        if not os.path.isdir(git.repo()):
+            return
+        status, stdout = git.git('for-each-ref',
+                                 '--format=%(refname:short)%00'
+                                 '%(objectname)%00'
+                                 '%(tree)%00'
+                                 '%(committerdate:iso8601)%00'
+                                 '%(subject)',
+                                 'refs/heads')
+        for line in stdout.splitlines():
+            name, commit, tree, date, message = line.split('\0', 4)
+            blob = git.blob(tree, 'summary.json')
+            if blob is None:
+                counts = {}
+            else:
+                counts = json.loads(git.content(blob))
+            yield {'name': name,
+                   'commit': commit,
+                   'date': date,
+                   'message': message,
+                   'files': counts.get('files'),
+                   'packages': counts.get('packages'),
+                   'services': counts.get('services'),
+                   'sources': counts.get('sources')}
+
+    @classmethod
+    def load(cls, f, name=None, validate=False):
         """
         Instantiate and return a Blueprint object from a file-like object
-        from which valid blueprint JSON may be read.
+        from which valid blueprint JSON may be read.  If `validate` is true,
+        raise `ValueError` if the JSON doesn't describe a blueprint.
         """
-        return cls(name, **json.load(f))
+        data = json.load(f)
+        if validate:
+            cls.validate(data)
+        return cls(name, **data)
 
     @classmethod
-    def loads(cls, s, name=None):
+    def loads(cls, s, name=None, validate=False):
         """
         Instantiate and return a Blueprint object from a string containing
-        valid blueprint JSON.
+        valid blueprint JSON.  If `validate` is true, raise `ValueError` if
+        the JSON doesn't describe a blueprint.
         """
-        return cls(name, **json.loads(s))
+        data = json.loads(s)
+        if validate:
+            cls.validate(data)
+        return cls(name, **data)
+
+    @classmethod
+    def validate(cls, data):
+        """
+        Raise `ValueError` unless the naive structure in `data`, as parsed
+        from blueprint JSON, has the form described in `blueprint`(5).
+        """
+        def strings(o):
+            return isinstance(o, list) \
+                and all([isinstance(s, basestring) for s in o])
+
+        if not isinstance(data, dict):
+            raise ValueError('blueprint must be an object')
+        for key in ('files', 'packages', 'services', 'sources'):
+            if not isinstance(data.get(key, {}), dict):
+                raise ValueError('{0} must be an object'.format(key))
+
+        for pathname, f in data.get('files', {}).iteritems():
+            if not isinstance(f, dict) \
+            or not ('content' in f or 'source' in f or 'template' in f
+                    or 'blob' in f):
+                raise ValueError('file {0} has no content'.format(pathname))
+
+            # Content may be JSON.  Keys `blueprint`(5) doesn't define, like
+            # those of AWS cfn-init files, are allowed through as they are.
+            for key in ('blob',
+                        'data',
+                        'encoding',
+                        'group',
+                        'mode',
+                        'owner',
+                        'source',
+                        'template'):
+                if key in f and not isinstance(f[key], basestring):
+                    raise ValueError('file {0} {1} must be a string'.
+                                     format(pathname, key))
+
+        for manager, packages in data.get('packages', {}).iteritems():
+            if not isinstance(packages, dict):
+                raise ValueError('manager {0} must be an object'.
+                                 format(manager))
+
+            # Packages installed at any version are serialized with `null`
+            # as their version.
+            for package, versions in packages.iteritems():
+                if isinstance(versions, list):
+                    versions = [version for version in versions
+                                if version is not None]
+                if not isinstance(versions, basestring) \
+                and not strings(versions):
+                    raise ValueError('package {0} {1} versions must be '
+                                     'strings'.format(manager, package))
+
+        for manager, services in data.get('services', {}).iteritems():
+            if not isinstance(services, dict):
+                raise ValueError('manager {0} must be an object'.
+                                 format(manager))
+            for service, deps in services.iteritems():
+                if not isinstance(deps, dict) \
+                or not strings(deps.get('files', [])) \
+                or not strings(deps.get('sources', [])) \
+                or not isinstance(deps.get('packages', {}), dict) \
+                or not all([strings(packages) for packages
+                            in deps.get('packages', {}).itervalues()]):
+                    raise ValueError('service {0} {1} has invalid '
+                                     'dependencies'.format(manager, service))
+
+        for dirname, filename in data.get('sources', {}).iteritems():
+            if not isinstance(filename, basestring):
+                raise ValueError('source {0} must be a string'.
+                                 format(dirname))
+
+    @classmethod
+    def _from_cache(cls, name, commit, data):
+        """
+        Instantiate and return a Blueprint object from the plain structure
+        produced by `_to_cache`, restoring the `defaultdict`s along the way.
+        """
+        b = cls(name, commit)
+        for key, value in data.iteritems():
+            if 'files' == key:
+                value = defaultdict(dict, [(pathname, lazy.file(f))
+                                           for pathname, f
+                                           in value.iteritems()])
+            elif 'packages' == key:
+                value = defaultdict(lambda: defaultdict(set),
+                                    [(managers.PackageManager(manager),
+                                      defaultdict(set, packages))
+                                     for manager, packages
+                                     in value.iteritems()])
+            elif 'services' == key:
+                for services in value.itervalues():
+                    for service in services.itervalues():
+                        if 'packages' in service:
+                            service['packages'] = defaultdict(
+                                set, service['packages'])
+                value = defaultdict(lambda: defaultdict(dict),
+                                    [(managers.ServiceManager(manager),
+                                      defaultdict(dict, services))
+                                     for manager, services
+                                     in value.iteritems()])
+            elif 'sources' == key:
+                value = defaultdict(dict, value)
+            b[key] = value
+        return b
 
     @classmethod
     def rules(cls, r, name=None):
@@ -123,98 +286,165 @@ class Blueprint(dict):
     def __init__(self, name=None, commit=None, *args, **kwargs):
         """
         Construct a blueprint.  Extra arguments are used to create a `dict`
-        which is then sent through the `blueprint`(5) algorithm to be injested
-        into this `Blueprint` object with the proper types.  (The structure
-        makes heavy use of `defaultdict` and `set`).
+        which is then injested into this `Blueprint` object with the proper
+        types.  (The structure makes heavy use of `defaultdict` and `set`).
         """
         self.name = name
         self._commit = commit
-        def file(pathname, f):
-            self.add_file(pathname, **f)
-        def package(manager, package, version):
-            self.add_package(manager, package, version)
-        def service(manager, service):
-            self.add_service(manager, service)
-        def service_file(manager, service, pathname):
-            self.add_service_file(manager, service, pathname)
-        def service_package(manager, service, package_manager, package):
-            self.add_service_package(manager,
-                                     service,
-                                     package_manager,
-                                     package)
-        def service_source(manager, service, dirname):
-            self.add_service_source(manager, service, dirname)
-        def source(dirname, filename, gen_content, url):
-            if url is not None:
-                self.add_source(dirname, url)
-            elif gen_content is not None:
-                self.add_source(dirname, filename)
-        walk.walk(dict(*args, **kwargs),
-                  file=file,
-                  package=package,
-                  service=service,
-                  service_file=service_file,
-                  service_package=service_package,
-                  service_source=service_source,
-                  source=source)
+
+        # Sorted views of resources cached by `walk` and cleared by the
+        # `add_*` methods.
+        self._views = {}
+
+        self._ingest(dict(*args, **kwargs))
+
+    def _ingest(self, data):
+        """
+        Convert the naive structure of `dict`s and `list`s in `data`, as
+        parsed from blueprint JSON, into this blueprint's `defaultdict`s and
+        `set`s in one pass, without the callbacks and sorting of walking it.
+        The result is the same as if each resource the `blueprint`(5)
+        algorithm visits were added with the `add_*` methods.
+        """
+        sources = data.get('sources', {})
+        if 0 < len(sources):
+            self['sources'] = defaultdict(dict, sources)
+
+        # AWS cfn-init templates may specify file content as JSON, which
+        # must be converted to a string here, as `walk.walk_files` does.
+        # Content stored in its own blob isn't read until it's needed.
+        files = data.get('files', {})
+        if 0 < len(files):
+            self['files'] = defaultdict(dict)
+            for pathname, f in files.iteritems():
+                f = lazy.file(f)
+                if not isinstance(f, lazy.File) and 'content' in f \
+                and not isinstance(f['content'], basestring):
+                    f['content'] = util.json_dumps(f['content'])
+                self['files'][pathname] = f
+
+        # Only managers that can be reached from `apt`, `rpm`, and `yum`
+        # are kept.  Packages without versions get `None` for a version.
+        packages = data.get('packages', {})
+        pending = ['apt', 'rpm', 'yum']
+        visited = set()
+        while 0 < len(pending):
+            managername = pending.pop()
+            if managername in visited:
+                continue
+            visited.add(managername)
+            packages2 = defaultdict(set)
+            for package, versions in packages.get(managername,
+                                                  {}).iteritems():
+                if 0 == len(versions):
+                    packages2[package] = set([None])
+                elif isinstance(versions, basestring):
+                    packages2[package] = set([versions])
+                else:
+                    packages2[package] = set(versions)
+                if managername != package and package in packages:
+                    pending.append(package)
+            if 0 < len(packages2):
+                self.packages[managers.PackageManager(managername)] = \
+                    packages2
+
+        # Services keep only their dependencies, along with the
+        # `enable` and `ensureRunning` parameters `add_service` gives them.
+        for managername, services in data.get('services', {}).iteritems():
+            services2 = defaultdict(dict)
+            for service, deps in services.iteritems():
+                deps2 = {'enable': True, 'ensureRunning': True}
+                if 0 < len(deps.get('files', [])):
+                    deps2['files'] = set(deps['files'])
+                packages = defaultdict(set)
+                for package_managername, packages2 in deps.get('packages',
+                                                               {}).iteritems():
+                    if 0 < len(packages2):
+                        packages[package_managername] = set(packages2)
+                if 0 < len(packages):
+                    deps2['packages'] = packages
+                if 0 < len(deps.get('sources', [])):
+                    deps2['sources'] = set(deps['sources'])
+                services2[service] = deps2
+            if 0 < len(services2):
+                self.services[managers.ServiceManager(managername)] = \
+                    services2
 
     def __sub__(self, other):
         """
         Subtracting one blueprint from another allows blueprints to remain
-        free of superfluous packages from the base installation.  It takes
-        three passes through the package tree.  The first two remove
-        superfluous packages and the final one accounts for some special
-        dependencies by adding them back to the tree.
-        """
-        b = copy.deepcopy(self)
+        free of superfluous packages from the base installation.  The
+        difference is built by selecting what to keep from this blueprint,
+        sharing its files rather than copying them.  The other blueprint's
+        package tree is walked once and replayed by three passes.  The first
+        two remove superfluous packages and the final one accounts for some
+        special dependencies by adding them back to the tree.
+        """
+        b = self.__class__(self.name, self._commit)
+        for key, value in self.iteritems():
+            if key not in ('files', 'packages', 'services', 'sources'):
+                b[key] = copy.deepcopy(value)
 
         # Compare file contents and metadata.  Keep files that differ.
-        for pathname, file in self.files.iteritems():
-            if other.files.get(pathname, {}) == file:
-                del b.files[pathname]
+        if 'files' in self:
+            files = other.get('files', {})
+            b['files'] = defaultdict(dict,
+                                     [(pathname, file)
+                                      for pathname, file
+                                      in self['files'].iteritems()
+                                      if files.get(pathname, {}) != file])
+
+        # Version sets are shared, too, so the first pass replaces rather
+        # than modifies those it removes versions from.
+        if 'packages' in self:
+            b['packages'] = defaultdict(lambda: defaultdict(set),
+                                        [(manager, defaultdict(set, packages))
+                                         for manager, packages
+                                         in self['packages'].iteritems()])
+        events = []
+        managers = []
+        for event in walk.package_events(other):
+            if 'package' == event[0]:
+                events.append(event[1:])
+            elif 'after_packages' == event[0]:
+                managers.append(event[1])
 
         # The first pass removes all duplicate packages that are not
         # themselves managers.  Allowing multiple versions of the same
         # packages complicates things slightly.  For each package, each
         # version that appears in the other blueprint is removed from
-        # this blueprint.  After that is finished, this blueprint is
-        # normalized.  If no versions remain, the package is removed.
-        def package(manager, package, version):
+        # this blueprint.  If no versions remain, the package is removed.
+        for manager, package, version in events:
             if package in b.packages:
-                return
-            try:
-                b_packages = b.packages[manager]
-            except KeyError:
-                return
-            if manager in b_packages:
-                return
-            if package not in b_packages:
-                return
-            try:
-                b_versions = b_packages[package]
-            except KeyError:
-                return
-            b_versions.discard(version)
+                continue
+            b_packages = b.packages[manager]
+            if manager in b_packages or package not in b_packages:
+                continue
+            b_versions = b_packages[package].difference([version])
             if 0 == len(b_versions):
                 del b_packages[package]
             else:
                 b_packages[package] = b_versions
-        other.walk(package=package)
 
         # The second pass removes managers that manage no packages, a
-        # potential side-effect of the first pass.  This step must be
-        # applied repeatedly until the blueprint reaches a steady state.
-        def package(manager, package, version):
-            if package not in b.packages:
-                return
-            if 0 == len(b.packages[package]):
-                del b.packages[package]
-                del b.packages[self.managers[package]][package]
-        while 1:
-            l = len(b.packages)
-            other.walk(package=package)
-            if len(b.packages) == l:
-                break
+        # potential side-effect of the first pass, if they're also packages
+        # in the other blueprint.  Removing a manager from its own manager
+        # may leave that one empty, too, so follow the chain upward rather
+        # than walking the other blueprint until nothing changes.  Managers
+        # this blueprint doesn't have are empty only because the first pass
+        # looked them up so they have nothing to be removed from.
+        candidates = set([package for manager, package, version in events])
+        pending = [package for package in candidates
+                   if package in b.packages and 0 == len(b.packages[package])]
+        while 0 < len(pending):
+            package = pending.pop()
+            del b.packages[package]
+            if package not in self.managers:
+                continue
+            manager = self.managers[package]
+            del b.packages[manager][package]
+            if manager in candidates and 0 == len(b.packages[manager]):
+                pending.append(manager)
 
         # The third pass adds back special dependencies like `ruby*-dev`.
         # It isn't apparent from the rules above that a manager like RubyGems
@@ -222,20 +452,18 @@ class Blueprint(dict):
         # be considered a missing dependency in the Debian archive but in
         # reality it's only _likely_ that you need `ruby*-dev` to use
         # `rubygems*`.
-        def after_packages(manager):
+        deps = {r'^python(\d+(?:\.\d+)?)$': ['python{0}',
+                                             'python{0}-dev',
+                                             'python',
+                                             'python-devel'],
+                r'^ruby(\d+\.\d+(?:\.\d+)?)$': ['ruby{0}-dev'],
+                r'^rubygems(\d+\.\d+(?:\.\d+)?)$': ['ruby{0}',
+                                                    'ruby{0}-dev',
+                                                    'ruby',
+                                                    'ruby-devel']}
+        for manager in managers:
             if manager not in b.packages:
-                return
-
-            deps = {r'^python(\d+(?:\.\d+)?)$': ['python{0}',
-                                                 'python{0}-dev',
-                                                 'python',
-                                                 'python-devel'],
-                    r'^ruby(\d+\.\d+(?:\.\d+)?)$': ['ruby{0}-dev'],
-                    r'^rubygems(\d+\.\d+(?:\.\d+)?)$': ['ruby{0}',
-                                                        'ruby{0}-dev',
-                                                        'ruby',
-                                                        'ruby-devel']}
-
+                continue
             for pattern, packages in deps.iteritems():
                 match = re.search(pattern, manager)
                 if match is None:
@@ -247,21 +475,36 @@ class Blueprint(dict):
                                                                       None)
                         if mine is not None:
                             b.packages[managername][package] = mine
-        other.walk(after_packages=after_packages)
 
-        # Compare service metadata.  Keep services that differ.
-        for manager, services in self.services.iteritems():
-            for service, deps in services.iteritems():
-                if other.services.get(manager, {}).get(service, {}) == deps:
-                    del b.services[manager][service]
-            if 0 == len(b.services[manager]):
-                del b.services[manager]
+        # The `add_*` methods change version sets in place so those kept are
+        # copied lest changing the difference change this blueprint, too.
+        for packages in b.get('packages', {}).itervalues():
+            for package, versions in packages.iteritems():
+                if isinstance(versions, set):
+                    packages[package] = set(versions)
+
+        # Compare service metadata.  Keep copies of services that differ.
+        if 'services' in self:
+            services = other.get('services', {})
+            b['services'] = defaultdict(lambda: defaultdict(dict))
+            for manager, services2 in self['services'].iteritems():
+                services3 = [(service, copy.deepcopy(deps))
+                             for service, deps in services2.iteritems()
+                             if services.get(manager,
+                                             {}).get(service, {}) != deps]
+                if 0 < len(services3):
+                    b['services'][manager] = defaultdict(dict, services3)
 
         # Compare source tarball filenames, which indicate their content.
         # Keep source tarballs that differ.
-        for dirname, filename in self.sources.iteritems():
-            if other.sources.get(dirname, '') == filename:
-                del b.sources[dirname]
+        if 'sources' in self:
+            sources = other.get('sources', {})
+            b['sources'] = defaultdict(dict,
+                                       [(dirname, filename)
+                                        for dirname, filename
+                                        in self['sources'].iteritems()
+                                        if filename != sources.get(dirname,
+                                                                   '')])
 
         return b
 
@@ -299,12 +542,12 @@ class Blueprint(dict):
         if hasattr(self, '_managers'):
             return self._managers
         self._managers = {'apt': None, 'yum': None}
-
-        def package(manager, package, version):
+        for event in walk.package_events(self):
+            if 'package' != event[0]:
+                continue
+            manager, package, version = event[1:]
             if package in self.packages and manager != package:
                 self._managers[package] = manager
-
-        self.walk(package=package)
         return self._managers
 
     @property
@@ -329,13 +572,18 @@ class Blueprint(dict):
         """
         Create a file resource.
         """
+        self._views.clear()
         self.files[pathname] = kwargs
 
     def add_package(self, manager, package, version):
         """
         Create a package resource.
         """
-        self.packages[manager][package].add(version)
+        self._views.clear()
+        versions = self.packages[manager][package]
+        if not isinstance(versions, set):
+            versions = self.packages[manager][package] = set(versions)
+        versions.add(version)
 
     def add_service(self, manager, service):
         """
@@ -344,6 +592,7 @@ class Blueprint(dict):
 
         # AWS cfn-init respects the enable and ensure parameters like Puppet
         # does.  Blueprint provides these parameters for interoperability.
+        self._views.clear()
         self.services[manager].setdefault(service, {'enable': True,
                                                     'ensureRunning': True})
 
@@ -382,6 +631,7 @@ class Blueprint(dict):
         """
         Create a source tarball resource.
         """
+        self._views.clear()
         self.sources[dirname] = filename
 
     def commit(self, message=''):
@@ -394,42 +644,125 @@ class Blueprint(dict):
         refname = 'refs/heads/{0}'.format(self.name)
         parent = git.rev_parse(refname)
 
-        # Start with an empty index every time.  Specifically, clear out
-        # source tarballs from the parent commit.
-        if parent is not None:
-            for mode, type, sha, pathname in git.ls_tree(git.tree(parent)):
-                git.git('update-index', '--force-remove', pathname)
-
-        # Add `blueprint.json` to the index.
-        f = open('blueprint.json', 'w')
-        f.write(self.dumps())
-        f.close()
-        git.git('update-index', '--add', os.path.abspath('blueprint.json'))
-
-        # Add source tarballs to the index.
+        # Collect `(mode, sha, pathname)` entries for the new tree, writing
+        # blobs to Git's object store in as few commands as possible.  If so
+        # configured, store file content as blobs at `files/<pathname>` that
+        # `blueprint.json` references.  Add `blueprint.json` by way of a
+        # temporary file so it's never in memory all at once.
+        self.normalize()
+        data, entries = self, []
+        if 'files' in self and cfg.getboolean('files', 'blobs'):
+            data = dict(self)
+            data['files'], entries = lazy.write(self.files)
+        f = tempfile.TemporaryFile()
+        try:
+            util.json_dump(data, f)
+            f.seek(0)
+            entries.append(('100644', git.hash_object(f), 'blueprint.json'))
+        finally:
+            f.close()
+
+        # Add source tarballs and their manifests, splitting uncompressed
+        # tarballs into chunks if so configured.  Tarballs that aren't in the
+        # working directory were reused from the parent commit, as were
+        # their manifests, and are stored as they were.  Tarballs found in
+        # neither place make git-hash-object(1) fail.
+        if parent is None:
+            entries2 = []
+        else:
+            entries2 = list(git.ls_tree(git.tree(parent)))
+        pathnames = []
+        dirnames = []
         for filename in self.sources.itervalues():
-            git.git('update-index', '--add', os.path.abspath(filename))
-
-        # Add `/etc/blueprintignore` and `~/.blueprintignore` to the index.
-        # Since adding extra syntax to this file, it no longer makes sense
-        # to store it as `.gitignore`.
-        f = open('blueprintignore', 'w')
+            for filename2 in (filename, '{0}.manifest'.format(filename)):
+                if os.path.exists(filename2):
+                    if filename2 == filename and '.tar' == filename[-4:] \
+                    and cfg.getboolean('sources', 'chunks'):
+                        pathnames.extend(chunks.write(filename))
+                        dirnames.append('{0}.chunks'.format(filename))
+                    else:
+                        pathnames.append(filename2)
+                    continue
+                entries3 = chunks.select(entries2, filename2)
+                if 0 < len(entries3):
+                    entries.extend([('100644', sha, pathname)
+                                    for sha, pathname in entries3])
+                elif filename2 == filename:
+                    pathnames.append(filename2)
+        try:
+            entries.extend([('100644', sha, pathname)
+                            for sha, pathname
+                            in zip(git.hash_objects(pathnames), pathnames)])
+        finally:
+            for dirname in dirnames:
+                shutil.rmtree(dirname)
+
+        # Add `/etc/blueprintignore` and `~/.blueprintignore`.  Since adding
+        # extra syntax to this file, it no longer makes sense to store it as
+        # `.gitignore`.
+        content = ''
         for pathname in ('/etc/blueprintignore',
                          os.path.expanduser('~/.blueprintignore')):
             try:
-                f.write(open(pathname).read())
+                content += open(pathname).read()
             except IOError:
                 pass
-        f.close()
-        git.git('update-index', '--add', os.path.abspath('blueprintignore'))
+        entries.append(('100644', git.hash_object(content), 'blueprintignore'))
 
-        # Write the index to Git's object store.
+        # Add `summary.json` so `Blueprint.iter_summaries` can count resources
+        # without parsing `blueprint.json`.
+        entries.append(('100644',
+                        git.hash_object(util.json_dumps(self.summary())),
+                        'summary.json'))
+
+        # Start with an empty index every time, so nothing from the parent
+        # commit lingers, and write it to Git's object store.
+        git.update_index(entries)
         tree = git.write_tree()
 
         # Write the commit and update the tip of the branch.
         self._commit = git.commit_tree(tree, message, parent)
         git.git('update-ref', refname, self._commit)
 
+        # The parent is no longer the tip of the branch so drop its cache
+        # entry.
+        cache.prune()
+
+    def summary(self):
+        """
+        Return the number of each type of resource in this blueprint.
+        """
+        return {'files': len(self.get('files', {})),
+                'packages': sum([len(packages) for packages
+                                 in self.get('packages', {}).itervalues()]),
+                'services': sum([len(services) for services
+                                 in self.get('services', {}).itervalues()]),
+                'sources': len(self.get('sources', {}))}
+
+    def _to_cache(self):
+        """
+        Return the structure of this blueprint as plain `dict`s, `set`s, and
+        strings, which `marshal` can serialize.  Package and service managers
+        become plain `unicode` strings.  Files whose content hasn't been read
+        keep referencing their blobs.
+        """
+        def plain(o):
+            if isinstance(o, lazy.File) and o.blob is not None:
+                return o.reference()
+            if isinstance(o, dict):
+                return dict([(unicode(k) if isinstance(k, unicode) else k,
+                              plain(v)) for k, v in o.iteritems()])
+            return o
+        return plain(self)
+
+    def compact(self):
+        """
+        Convert this blueprint to the compact representation from
+        `blueprint.compact`, which takes much less memory when holding many
+        blueprints at once.
+        """
+        compact.compact(self)
+
     def normalize(self):
         """
         Remove superfluous empty keys to reduce variance in serialized JSON.
@@ -440,6 +773,14 @@ class Blueprint(dict):
             if key in self and 0 == len(self[key]):
                 del self[key]
 
+    def dump(self, f):
+        """
+        Write the same JSON serialization of this blueprint as `dumps` to
+        the file-like object `f` a piece at a time.
+        """
+        self.normalize()
+        util.json_dump(self, f)
+
     def dumps(self):
         """
         Return a JSON serialization of this blueprint.  Make a best effort
@@ -486,10 +827,31 @@ class Blueprint(dict):
         import frontend.cfn
         return frontend.cfn.cfn(self, relaxed)
 
+    def generate(self, names, relaxed=False):
+        """
+        Generate code for each of the named frontends, by the names of the
+        methods above, in one walk of this blueprint.  Return a list of the
+        results in the same order.
+        """
+        import frontend.cfn
+        import frontend.chef
+        import frontend.puppet
+        import frontend.rules
+        import frontend.sh
+        modules = {'blueprint_rules': frontend.rules,
+                   'cfn': frontend.cfn,
+                   'chef': frontend.chef,
+                   'puppet': frontend.puppet,
+                   'sh': frontend.sh}
+        visitors = [modules[name].visit(self, relaxed) for name in names]
+        self.walk(**walk.combine(*[callbacks
+                                   for callbacks, finish in visitors]))
+        return [finish() for callbacks, finish in visitors]
+
     def blueprintignore(self):
         """
-        Return an open file pointer to the blueprint's blueprintignore file,
-        which is suitable for passing back to `blueprint.rules.Rules.parse`.
+        Return the lines of the blueprint's blueprintignore file, which are
+        suitable for passing back to `blueprint.rules.Rules.parse`.
         Prior to v3.0.9 this file was stored as .blueprintignore in the
         repository.  Prior to v3.0.4 this file was stored as .gitignore in
         the repository.
@@ -502,7 +864,10 @@ class Blueprint(dict):
             blob = git.blob(tree, '.gitignore')
         if blob is None:
             return []
-        return git.cat_file(blob)
+        return git.content(blob).splitlines(True)
 
     def walk(self, **kwargs):
         walk.walk(self, **kwargs)
+
+    def events(self):
+        return walk.events(self)
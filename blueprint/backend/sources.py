@@ -4,24 +4,86 @@ Search for software built from source to include in the blueprint as a tarball.
 
 import errno
 import glob
+import gzip
 import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import os.path
 import re
 import shutil
 import stat
-import subprocess
 import tarfile
 
+import blueprint
+from blueprint import cfg
+from blueprint import chunks
 from blueprint import context_managers
+from blueprint import git
+from blueprint import rules
 from blueprint import util
 
 
-def _source(b, r, dirname, old_cwd):
-    tmpname = os.path.join(os.getcwd(), dirname[1:].replace('/', '-'))
-
-    exclude = []
+# Filename extensions of source tarballs by the compression used to create
+# them, which is configured in `blueprint.cfg`(5).
+EXTENSIONS = {'gzip': '.tar.gz',
+              'none': '.tar'}
+
+# How many bytes of a script in `/usr/local/bin` to search for the marks
+# left by `easy_install` and RubyGems.
+HEADER = 4096
+
+
+class _HashingWriter(object):
+    """
+    Write to an underlying file-like object while computing the SHA1 sum of
+    everything written, so a tarball can be named by its content without
+    being read back.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+        self.sha1 = hashlib.sha1()
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def tell(self):
+        return self.offset
+
+    def write(self, s):
+        self.f.write(s)
+        self.sha1.update(s)
+        self.offset += len(s)
+
+
+def _rubygems_update():
+    """
+    Return the set of pathnames, relative to the `lib` directory of every
+    installed `rubygems-update` gem, that make up the RubyGems package.
+    """
+    s = set()
+    for dirname in \
+        glob.glob('/usr/lib/ruby/gems/*/gems/rubygems-update-*/lib') + \
+        glob.glob('/var/lib/gems/*/gems/rubygems-update-*/lib'):
+        for dirpath, dirnames, filenames in os.walk(dirname):
+            for filename in filenames:
+                s.add(os.path.relpath(os.path.join(dirpath, filename),
+                                      dirname))
+    return s
+
+
+def _source(r, dirname, rubygems, previous, compression='none'):
+    """
+    Create a source tarball of `dirname` in the working directory and
+    return its filename, or return the filename of the previous tarball,
+    given with its manifest as `previous`, if it's unchanged.  Return `None`
+    if there's nothing worth archiving.  Compress the tarball as it's
+    written if `compression` is `'gzip'`.
+    """
+    exclude = set()
 
     pattern_pip = re.compile(r'\.egg-info/installed-files.txt$')
     pattern_egg = re.compile(r'\.egg(?:-info)?(?:/|$)')
@@ -29,75 +91,71 @@ def _source(b, r, dirname, old_cwd):
         r'lib/python[^/]+/(?:dist|site)-packages/easy-install.pth$')
     pattern_bin = re.compile(
         r'EASY-INSTALL(?:-ENTRY)?-SCRIPT|This file was generated by RubyGems')
-
-    # Create a partial shallow copy of the directory.
-    for dirpath, dirnames, filenames in os.walk(dirname):
-
-        # Definitely ignore the shallow copy directory.
-        if dirpath.startswith(tmpname):
-            continue
+    pattern_site_ruby = re.compile(r'/site_ruby/[^/]+/(.+)$')
+
+    def scan(dirpath):
+        """
+        Return the contents of `dirpath` that may belong in the tarball as
+        a list of `(pathname, children)` pairs in the order `tarfile` would
+        have archived them.  `children` is `None` for anything that isn't a
+        directory.  Return `None` if `dirpath` can't be listed.
+        """
+        try:
+            filenames = os.listdir(dirpath)
+        except OSError:
+            return None
 
         # Determine if this entire directory should be ignored by default.
         ignored = r.ignore_file(dirpath)
 
-        dirpath2 = os.path.normpath(
-            os.path.join(tmpname, os.path.relpath(dirpath, dirname)))
-
-        # Create this directory in the shallow copy with matching mode, owner,
-        # and owning group.  Suggest running as `root` if this doesn't work.
-        os.mkdir(dirpath2)
-        s = os.lstat(dirpath)
-        try:
-            try:
-                os.lchown(dirpath2, s.st_uid, s.st_gid)
-            except OverflowError:
-                logging.warning('{0} has uid:gid {1}:{2} - using chown(1)'.
-                                format(dirpath, s.st_uid, s.st_gid))
-                p = subprocess.Popen(['chown',
-                                      '{0}:{1}'.format(s.st_uid, s.st_gid),
-                                      dirpath2],
-                                     close_fds=True)
-                p.communicate()
-            os.chmod(dirpath2, s.st_mode)
-        except OSError as e:
-            logging.warning('{0} caused {1} - try running as root'.
-                            format(dirpath, errno.errorcode[e.errno]))
-            return
-
+        members = []
         for filename in filenames:
             pathname = os.path.join(dirpath, filename)
 
-            if r.ignore_source(pathname, ignored):
+            # Recurse into directories but not into symbolic links to
+            # directories, which are left out entirely.
+            if os.path.isdir(pathname):
+                if not os.path.islink(pathname):
+                    children = scan(pathname)
+                    if children is not None:
+                        members.append((pathname, children))
                 continue
 
-            pathname2 = os.path.join(dirpath2, filename)
+            if r.ignore_source(pathname, ignored):
+                continue
 
-            # Exclude files that are part of the RubyGems package.
-            for globname in (
-                os.path.join('/usr/lib/ruby/gems/*/gems/rubygems-update-*/lib',
-                             pathname[1:]),
-                os.path.join('/var/lib/gems/*/gems/rubygems-update-*/lib',
-                             pathname[1:])):
-                if 0 < len(glob.glob(globname)):
-                    continue
+            # Exclude files that are part of the RubyGems package, which
+            # `update_rubygems` copies into `site_ruby`.
+            match = pattern_site_ruby.search(pathname)
+            if match is not None and match.group(1) in rubygems:
+                continue
 
             # Remember the path to all of `pip`'s `installed_files.txt` files.
             if pattern_pip.search(pathname):
-                exclude.extend([os.path.join(dirpath2, line.rstrip())
-                    for line in open(pathname)])
+                exclude.update([os.path.normpath(os.path.join(dirpath,
+                                                              line.rstrip()))
+                                for line in open(pathname)])
 
             # Likewise remember the path to Python eggs.
             if pattern_egg.search(pathname):
-                exclude.append(pathname2)
+                exclude.add(pathname)
 
             # Exclude `easy_install`'s bookkeeping file, too.
             if pattern_pth.search(pathname):
                 continue
 
             # Exclude executable placed by Python packages or RubyGems.
+            # Both leave their mark in the header of the script, so only
+            # read that far and skip compiled programs altogether.
             if pathname.startswith('/usr/local/bin/'):
                 try:
-                    if pattern_bin.search(open(pathname).read()):
+                    f = open(pathname)
+                    try:
+                        header = f.read(HEADER)
+                    finally:
+                        f.close()
+                    if not header.startswith('\x7fELF') \
+                    and pattern_bin.search(header):
                         continue
                 except IOError as e:
                     pass
@@ -119,85 +177,207 @@ def _source(b, r, dirname, old_cwd):
                                         format(pathname))
                         continue
 
-            # Hard link this file into the shallow copy.  Suggest running as
-            # `root` if this doesn't work though in practice the check above
-            # will have already caught this problem.
-            try:
-                os.link(pathname, pathname2)
-            except OSError as e:
-                logging.warning('{0} caused {1} - try running as root'.
-                                format(pathname, errno.errorcode[e.errno]))
-                return
-
-    # Unlink files that were remembered for exclusion above.
-    for pathname in exclude:
-        try:
-            os.unlink(pathname)
-        except OSError as e:
-            if e.errno not in (errno.EISDIR, errno.ENOENT):
-                raise e
-
-    # Remove empty directories.  For any that hang around, match their
-    # access and modification times to the source, otherwise the hash of
-    # the tarball will not be deterministic.
-    for dirpath, dirnames, filenames in os.walk(tmpname, topdown=False):
-        try:
-            os.rmdir(dirpath)
-        except OSError:
-            s = os.lstat(os.path.join(dirname, os.path.relpath(dirpath,
-                                                               tmpname)))
-            os.utime(dirpath, (s.st_atime, s.st_mtime))
-
-    # If the shallow copy of still exists, create a tarball named by its
-    # SHA1 sum and include it in the blueprint.
+            members.append((pathname, None))
+
+        return members
+
+    def prune(members):
+        """
+        Remove files that were remembered for exclusion while scanning and
+        then any directories left empty.
+        """
+        pruned = []
+        for pathname, children in members:
+            if children is None:
+                if pathname not in exclude:
+                    pruned.append((pathname, None))
+            else:
+                children = prune(children)
+                if 0 < len(children):
+                    pruned.append((pathname, children))
+        return pruned
+
+    def flatten(pathname, arcname, children):
+        """
+        Generate the pathname and archive name of a file or directory and
+        everything beneath it in the order `tarfile.TarFile.add` would have
+        archived them.
+        """
+        yield pathname, arcname
+        for pathname2, children2 in children or []:
+            for member in flatten(pathname2,
+                                  os.path.join(arcname,
+                                               os.path.basename(pathname2)),
+                                  children2):
+                yield member
+
+    # Decide what belongs in the tarball in one pass through the directory.
+    # If nothing is left, there's no tarball to create.
+    members = scan(dirname)
+    if members is None:
+        return None
+    members = prune(members)
+    if 0 == len(members):
+        return None
+    members = list(flatten(dirname, '.', members))
+
+    # Reuse the previous tarball if nothing it was built from has changed
+    # since, without reading any file contents.
+    manifest = _manifest(members)
+    tarname, manifest2 = previous
+    if manifest == manifest2 and tarname.endswith(EXTENSIONS[compression]):
+        logging.info('reusing unchanged source tarball {0}'.format(tarname))
+        return tarname
+
+    # Stream the tarball to disk through a SHA1 sum, name it by that sum,
+    # and include it in the blueprint.  The result is identical to what
+    # `tarfile.TarFile.add` used to produce from a shallow copy.  When
+    # compressing, leave the timestamp and filename out of the gzip header
+    # so the same tree always produces the same compressed tarball.
+    f = open('tmp.tar', 'wb')
     try:
-        tar = tarfile.open('tmp.tar', 'w')
-        tar.add(tmpname, '.')
-    except OSError:
-        return
-    finally:
+        w = _HashingWriter(f)
+        if 'gzip' == compression:
+            z = gzip.GzipFile('', 'wb', 9, w, 0)
+            tar = tarfile.open(mode='w', fileobj=z)
+        else:
+            z = None
+            tar = tarfile.open(mode='w', fileobj=w)
+        for pathname, arcname in members:
+            tarinfo = tar.gettarinfo(pathname, arcname)
+            if tarinfo is None:
+                continue
+            if tarinfo.isreg():
+                f2 = open(pathname, 'rb')
+                try:
+                    tar.addfile(tarinfo, f2)
+                finally:
+                    f2.close()
+            else:
+                tar.addfile(tarinfo)
         tar.close()
-    sha1 = hashlib.sha1()
-    f = open('tmp.tar', 'r')
-    [sha1.update(buf) for buf in iter(lambda: f.read(4096), '')]
+        if z is not None:
+            z.close()
+    except (IOError, OSError) as e:
+        logging.warning('{0} caused {1} - try running as root'.
+                        format(getattr(e, 'filename', None) or dirname,
+                               errno.errorcode.get(e.errno, e)))
+        f.close()
+        os.unlink('tmp.tar')
+        return None
     f.close()
-    tarname = '{0}.tar'.format(sha1.hexdigest())
-    shutil.move('tmp.tar', os.path.join(old_cwd, tarname))
-    b.add_source(dirname, tarname)
+    tarname = '{0}{1}'.format(w.hexdigest(), EXTENSIONS[compression])
+    os.rename('tmp.tar', tarname)
+    f = open('{0}.manifest'.format(tarname), 'w')
+    f.write(manifest)
+    f.close()
+    return tarname
+
+
+def _source_worker(args):
+    """
+    Create a source tarball in a private temporary working directory and
+    move the results into the caller's working directory.  This runs in a
+    `multiprocessing.Pool` so its arguments are plain picklable data: the
+    rules as a `dict` plus the rest of the arguments to `_source`.
+    """
+    r, dirname, rubygems, previous, compression = args
+    with context_managers.mkdtemp() as c:
+        tarname = _source(rules.Rules(r),
+                          dirname,
+                          rubygems,
+                          previous,
+                          compression)
+        for filename in os.listdir('.'):
+            shutil.move(filename, os.path.join(c.cwd, filename))
+    return tarname
+
+
+def _manifest(members):
+    """
+    Return a string describing the metadata of each member of a source
+    tarball, one JSON array per line.  Regular files are described by
+    size, other files by their symbolic link target, and hard links by the
+    archive name of the first link.
+    """
+    inodes = {}
+    out = []
+    for pathname, arcname in members:
+        s = os.lstat(pathname)
+        size, target = 0, None
+        if stat.S_ISLNK(s.st_mode):
+            target = os.readlink(pathname)
+        elif not stat.S_ISDIR(s.st_mode) and 1 < s.st_nlink:
+            target = inodes.setdefault((s.st_dev, s.st_ino), arcname)
+            if arcname == target:
+                target = None
+        if stat.S_ISREG(s.st_mode) and target is None:
+            size = s.st_size
+        out.append(json.dumps([arcname,
+                               size,
+                               s.st_mtime,
+                               s.st_mode,
+                               s.st_uid,
+                               s.st_gid,
+                               target]))
+        out.append('\n')
+    return ''.join(out)
+
+
+def _previous(name):
+    """
+    Return a function that, given a source directory, returns the filename
+    of the source tarball and the content of its manifest from the most
+    recent revision of the named blueprint, or `(None, None)`.
+    """
+    try:
+        if name is None:
+            raise blueprint.NotFoundError(name)
+        b = blueprint.Blueprint.checkout(name)
+    except blueprint.NotFoundError:
+        return lambda dirname: (None, None)
+    tree = git.tree(b._commit)
+    def previous(dirname):
+        tarname = b.sources.get(dirname)
+        if tarname is None or chunks.blobs(tree, tarname) is None:
+            return None, None
+        blob = git.blob(tree, '{0}.manifest'.format(tarname))
+        if blob is None:
+            return None, None
+        return tarname, git.content(blob)
+    return previous
 
 
 def sources(b, r):
     logging.info('searching for software built from source')
-    for pathname, negate in r['source']:
-        if negate and os.path.isdir(pathname) \
-        and not r.ignore_source(pathname):
-
-            # Note before creating a working directory within pathname what
-            # it's atime and mtime should be.
-            s = os.lstat(pathname)
-
-            # Create a working directory within pathname to avoid potential
-            # EXDEV when creating the shallow copy and tarball.
-            try:
-                with context_managers.mkdtemp(pathname) as c:
-
-                    # Restore the parent of the working directory to its
-                    # original atime and mtime, as if pretending the working
-                    # directory never actually existed.
-                    os.utime(pathname, (s.st_atime, s.st_mtime))
-
-                    # Create the shallow copy and possibly tarball of the
-                    # relevant parts of pathname.
-                    _source(b, r, pathname, c.cwd)
-
-                # Once more restore the atime and mtime after the working
-                # directory is destroyed.
-                os.utime(pathname, (s.st_atime, s.st_mtime))
-
-            # If creating the temporary directory fails, bail with a warning.
-            except OSError as e:
-                logging.warning('{0} caused {1} - try running as root'.
-                                format(pathname, errno.errorcode[e.errno]))
+    compression = cfg.get('sources', 'compression')
+    if compression not in EXTENSIONS:
+        logging.warning('unknown source tarball compression {0} - '
+                        'not compressing'.format(compression))
+        compression = 'none'
+    rubygems = _rubygems_update()
+    previous = _previous(b.name)
+    dirnames = [pathname for pathname, negate in r['source']
+                if negate and os.path.isdir(pathname)
+                and not r.ignore_source(pathname)]
+    args = [(dict(r), dirname, rubygems, previous(dirname), compression)
+            for dirname in dirnames]
+
+    # Source directories are often on different disks so create their
+    # tarballs in parallel.  Results come back in the order of the rules,
+    # keeping the blueprint the same from run to run.
+    if 1 < len(dirnames):
+        pool = multiprocessing.Pool(len(dirnames))
+        try:
+            tarnames = pool.map(_source_worker, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tarnames = map(_source_worker, args)
+    for dirname, tarname in zip(dirnames, tarnames):
+        if tarname is not None:
+            b.add_source(dirname, tarname)
 
     if 0 < len(b.sources):
         b.arch = util.arch()
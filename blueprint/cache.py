@@ -0,0 +1,102 @@
+"""
+Cache parsed blueprints on disk by commit so reading the same commit again
+skips Git and JSON parsing.  Commits are immutable so entries never go
+stale but they are pruned once their commit is no longer the tip of a
+branch.  Each entry is stamped with `VERSION` and the `marshal` format
+version so a change to either makes old entries misses.
+"""
+
+import marshal
+import os
+import os.path
+import tempfile
+
+import git
+import util
+
+
+# Increment this when the structure of cached blueprints changes.
+VERSION = 2
+
+
+def dirname():
+    """
+    Return the full path to the cache directory.
+    """
+    return os.path.join(git.repo(), 'cache')
+
+
+def load(commit):
+    """
+    Return the cached structure of the blueprint in the given commit or
+    `None`.
+    """
+    try:
+        f = open(os.path.join(dirname(), commit), 'rb')
+    except IOError:
+        return None
+    try:
+        version, data = marshal.load(f)
+    except (EOFError, TypeError, ValueError):
+        return None
+    finally:
+        f.close()
+    if (VERSION, marshal.version) != version:
+        return None
+    return data
+
+
+def store(commit, data):
+    """
+    Cache the structure of the blueprint in the given commit.  Failure is
+    not an error since the cache is only an optimization.
+    """
+    try:
+        try:
+            os.mkdir(dirname())
+            if util.via_sudo():
+                os.chown(dirname(),
+                         int(os.environ['SUDO_UID']),
+                         int(os.environ['SUDO_GID']))
+        except OSError:
+            pass
+        fd, pathname = tempfile.mkstemp(dir=dirname())
+        f = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump(((VERSION, marshal.version), data), f)
+        except ValueError:
+            f.close()
+            os.unlink(pathname)
+            return
+        f.close()
+        if util.via_sudo():
+            os.chown(pathname,
+                     int(os.environ['SUDO_UID']),
+                     int(os.environ['SUDO_GID']))
+        os.rename(pathname, os.path.join(dirname(), commit))
+    except EnvironmentError:
+        pass
+
+
+def prune():
+    """
+    Remove the entries of commits that are no longer the tip of any branch,
+    like those replaced by a newer revision or belonging to a destroyed
+    blueprint.  Older revisions are rarely checked out again and are only
+    slower to read if they are.
+    """
+    try:
+        filenames = os.listdir(dirname())
+    except OSError:
+        return
+    status, stdout = git.git('for-each-ref',
+                             '--format=%(objectname)',
+                             'refs/heads')
+    commits = set(stdout.split())
+    for filename in filenames:
+        if filename in commits:
+            continue
+        try:
+            os.unlink(os.path.join(dirname(), filename))
+        except OSError:
+            pass
@@ -0,0 +1,149 @@
+"""
+Content-defined chunking of source tarballs stored in the local Git
+repository.  When `chunks` is enabled in `blueprint.cfg`(5), an uncompressed
+source tarball is stored as a tree of blobs named `<tarball>.chunks/<n>`
+rather than as a single blob.  Chunk boundaries fall between tar members
+and are chosen by hashing member names, so a change to one file changes only
+the chunk that contains it and Git stores the rest once.  Tarballs are
+reassembled by concatenating the chunks in order.
+"""
+
+import os
+import os.path
+import tarfile
+import tempfile
+import zlib
+
+import git
+
+
+# On average, start a new chunk every 16 tar members.  No chunk grows past
+# `MAX` bytes unless a single member is larger.
+MASK = 15
+MAX = 4194304
+
+
+def split(pathname):
+    """
+    Generate the offset and length of each chunk of the uncompressed tarball
+    at `pathname`.  A tarball that can't be read as such is one chunk.
+    """
+    size = os.path.getsize(pathname)
+    start = 0
+    try:
+        tar = tarfile.open(pathname, 'r:')
+        for tarinfo in tar:
+            if start < tarinfo.offset \
+            and (0 == zlib.crc32(tarinfo.name) & MASK
+                 or MAX < tarinfo.offset_data + tarinfo.size - start):
+                yield start, tarinfo.offset - start
+                start = tarinfo.offset
+
+            # Split the data of huge members into pieces relative to the
+            # start of the member so their boundaries don't shift.
+            while MAX < tarinfo.offset_data + tarinfo.size - start:
+                yield start, MAX
+                start += MAX
+
+        tar.close()
+    except (tarfile.TarError, IOError):
+        pass
+    if start < size:
+        yield start, size - start
+
+
+def write(filename):
+    """
+    Split the named tarball in the working directory into files in the
+    `<filename>.chunks` directory, which are named as they will be in Git.
+    Return a list of their pathnames in order.
+    """
+    dirname = '{0}.chunks'.format(filename)
+    os.mkdir(dirname)
+    pathnames = []
+    f = open(filename, 'rb')
+    for i, (offset, length) in enumerate(split(filename)):
+        pathname = os.path.join(dirname, '{0:08d}'.format(i))
+        f2 = open(pathname, 'wb')
+        while 0 < length:
+            buf = f.read(min(length, 65536))
+            if '' == buf:
+                break
+            f2.write(buf)
+            length -= len(buf)
+        f2.close()
+        pathnames.append(pathname)
+    f.close()
+    return pathnames
+
+
+def select(entries, filename):
+    """
+    Return a list of `(sha, pathname)` pairs for the blobs among the
+    `(mode, type, sha, pathname)` tree entries given that make up the named
+    tarball, whether stored whole or in chunks.
+    """
+    prefix = '{0}.chunks/'.format(filename)
+    return [(sha, pathname)
+            for mode, type, sha, pathname in entries
+            if filename == pathname or pathname.startswith(prefix)]
+
+
+def entries(tree, filename):
+    """
+    Return a list of `(sha, pathname)` pairs for the blobs in the given tree
+    that make up the named tarball, whether stored whole or in chunks.  Only
+    the top level of the tree and the tarball's own chunks are read.
+    """
+    level = git.ls_level(tree)
+    entry = level.get(filename)
+    if entry is not None and '40000' != entry[0]:
+        return [(entry[1], filename)]
+    dirname = '{0}.chunks'.format(filename)
+    entry = level.get(dirname)
+    if entry is None or '40000' != entry[0]:
+        return []
+    level = git.ls_level(entry[1])
+    return [(level[filename2][1], '{0}/{1}'.format(dirname, filename2))
+            for filename2 in sorted(level.iterkeys())
+            if '40000' != level[filename2][0]]
+
+
+def blobs(tree, filename):
+    """
+    Return the SHAs of the blobs in the given tree that, concatenated in
+    order, make up the named tarball or `None`.
+    """
+    shas = [sha for sha, pathname in entries(tree, filename)]
+    if 0 == len(shas):
+        return None
+    return shas
+
+
+def stream(blobs):
+    """
+    Generate the content of a tarball reassembled from its blobs in pieces
+    of bounded size.
+    """
+    for blob in blobs:
+        for piece in git.stream(blob):
+            yield piece
+
+
+def cat_file(blobs, pathname=None):
+    """
+    If `pathname` is `None`, return an open temporary file containing a
+    tarball reassembled from its blobs, otherwise stream it to `pathname`.
+    """
+    if pathname is None:
+        f = tempfile.TemporaryFile()
+    elif 1 == len(blobs):
+        return git.cat_file(blobs[0], pathname)
+    else:
+        f = open(pathname, 'w')
+    for piece in stream(blobs):
+        f.write(piece)
+    if pathname is None:
+        f.seek(0)
+        return f
+    f.close()
@@ -23,7 +23,9 @@ def create(options, args):
 
             if not os.isatty(sys.stdin.fileno()):
                 try:
-                    b = blueprint.Blueprint.load(sys.stdin, args[0])
+                    b = blueprint.Blueprint.load(sys.stdin,
+                                                  args[0],
+                                                  validate=True)
                 except ValueError:
                     logging.error(
                         'standard input contains invalid blueprint JSON')
@@ -61,7 +63,9 @@ def read(options, args):
                 # TODO This implementation won't be able to find source
                 # tarballs that should be associated with the blueprint
                 # on standard input.
-                return blueprint.Blueprint.load(sys.stdin, name)
+                return blueprint.Blueprint.load(sys.stdin,
+                                                name,
+                                                validate=True)
 
             except ValueError:
                 logging.error('standard input contains invalid blueprint JSON')
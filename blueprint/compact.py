@@ -0,0 +1,190 @@
+"""
+A compact in-memory representation of blueprints for holding many of them
+at once.  File resources become `__slots__` records in place of `dict`s,
+package versions become tuples in place of `set`s, and the small strings
+repeated across resources and blueprints, like owners, modes, pathnames,
+package names, and versions, are interned so each is stored once.  Compact
+resources read like the `dict`s and `set`s they replace so walking,
+subtracting, comparing, serializing, and the frontends work as before.
+"""
+
+import collections
+from collections import defaultdict
+
+import lazy
+
+
+# Interned strings.  Python's `intern` only accepts `str`, not the `unicode`
+# strings parsed from JSON.
+_strings = {}
+
+
+def intern(s):
+    """
+    Return the one copy of the given string, or `None`.
+    """
+    if s is None:
+        return None
+    return _strings.setdefault(s, s)
+
+
+class File(object):
+    """
+    A file resource with its metadata interned.  Files with keys beyond
+    those `blueprint`(5) defines keep the rest in a `dict`.
+    """
+
+    KEYS = ('content',
+            'data',
+            'encoding',
+            'group',
+            'mode',
+            'owner',
+            'source',
+            'template')
+    __slots__ = KEYS + ('extra',)
+
+    # Content and templates are too large and too varied to intern.
+    INTERNED = frozenset(['encoding', 'group', 'mode', 'owner', 'source'])
+
+    def __init__(self, f):
+
+        # Intern inline since there are so many files to construct.
+        for key, value in f.iteritems():
+            if key in self.INTERNED:
+                setattr(self, key, _strings.setdefault(value, value))
+            else:
+                self[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+    has_key = __contains__
+
+    def __delitem__(self, key):
+        try:
+            if key in self.KEYS:
+                delattr(self, key)
+            else:
+                del self.extra[key]
+        except (AttributeError, KeyError):
+            raise KeyError(key)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    __hash__ = None
+
+    def __getitem__(self, key):
+        try:
+            if key in self.KEYS:
+                return getattr(self, key)
+            return self.extra[key]
+        except (AttributeError, KeyError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __setitem__(self, key, value):
+        if key in self.INTERNED:
+            setattr(self, key, intern(value))
+        elif key in self.KEYS:
+            setattr(self, key, value)
+        else:
+            try:
+                self.extra[intern(key)] = value
+            except AttributeError:
+                self.extra = {intern(key): value}
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        for key in self.KEYS:
+            try:
+                yield key, getattr(self, key)
+            except AttributeError:
+                pass
+        for item in getattr(self, 'extra', {}).iteritems():
+            yield item
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def keys(self):
+        return [key for key, value in self.iteritems()]
+
+    def values(self):
+        return list(self.itervalues())
+
+collections.Mapping.register(File)
+
+
+class Versions(tuple):
+    """
+    The versions of a package as an immutable tuple, in the order the `set`
+    it replaces iterated them, with the set methods subtraction uses.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, versions):
+        return super(Versions, cls).__new__(cls, [intern(version)
+                                                  for version in versions])
+
+    def difference(self, *others):
+        return set(self).difference(*others)
+
+
+def compact(b):
+    """
+    Convert the given blueprint to the compact representation in place.
+    Files whose content is yet to be read from Git stay `lazy.File`s.
+    """
+    if 'files' in b:
+        b['files'] = defaultdict(dict, [(intern(pathname),
+                                         f if isinstance(f, (File, lazy.File))
+                                         else File(f))
+                                        for pathname, f
+                                        in b['files'].iteritems()])
+
+    for manager, packages in b.get('packages', {}).iteritems():
+        for package in packages.keys():
+            packages[intern(package)] = Versions(packages.pop(package))
+
+    # Cached walk views name resources by the strings just interned and
+    # files by their replaced container, so they're dropped, too.
+    views = getattr(b, '_views', None)
+    if views is not None:
+        views.clear()
@@ -0,0 +1,259 @@
+"""
+Compare many blueprints at once.  Each resource is indexed by its type and
+name, then by its content, to a bitmap of the blueprints that have it, so
+finding which blueprints differ on which resources takes one pass over each
+blueprint rather than a subtraction for every pair.  The same index finds
+the resources that all or a quorum of the blueprints have in common.
+"""
+
+import collections
+import hashlib
+
+import blueprint
+import lazy
+import walk
+
+
+# The types of resources in the order they're compared.
+TYPES = ('source', 'file', 'package', 'service')
+
+
+def resources(b):
+    """
+    Generate a `(resource, value)` pair for each resource in the given
+    blueprint.  Resources are tuples of a type from `TYPES` and the names
+    that identify a resource of that type.  Values are hashable and equal
+    exactly when the resources' content and metadata are equal.
+    """
+    packages = {}
+    for event in walk.events(b):
+        if 'source' == event[0]:
+            dirname, filename, gen_content, url = event[1:]
+            yield ('source', dirname), url or filename
+        elif 'file' == event[0]:
+            pathname, f = event[1:]
+            yield ('file', pathname), _file(f)
+        elif 'package' == event[0]:
+            manager, package, version = event[1:]
+            packages.setdefault(('package', manager, package),
+                                set()).add(version)
+        elif 'service' == event[0]:
+            manager, service = event[1:]
+            deps = b['services'][manager][service]
+            yield ('service', manager, service), _hashable(deps)
+    for resource, versions in packages.iteritems():
+        yield resource, frozenset(versions)
+
+
+def _file(f):
+    """
+    Return a hashable equivalent of the given file resource with its content
+    represented by the SHA of its Git blob.  Files whose content is yet to be
+    read from a blob aren't read and are equal to the same content inline.
+    """
+    if isinstance(f, lazy.File) and f.blob is not None:
+        items = dict.items(f) + [('content', f.blob)]
+    else:
+        items = [(k, _blob(v) if 'content' == k else v)
+                 for k, v in f.iteritems()]
+    return tuple(sorted([(k, _hashable(v)) for k, v in items]))
+
+
+def _blob(content):
+    """
+    Return the SHA of the Git blob of the given content, as `lazy.write`
+    stores it, or the content itself if it isn't a string.
+    """
+    if not isinstance(content, basestring):
+        return content
+    if isinstance(content, unicode):
+        content = content.encode('utf_8')
+    return hashlib.sha1('blob {0}\0{1}'.format(len(content),
+                                                content)).hexdigest()
+
+
+def _hashable(o):
+    """
+    Return a hashable equivalent of the given structure of `dict`s, `list`s,
+    and `set`s.
+    """
+    if isinstance(o, collections.Mapping):
+        return tuple(sorted([(k, _hashable(v)) for k, v in o.iteritems()]))
+    if isinstance(o, (list, tuple)):
+        return tuple([_hashable(v) for v in o])
+    if isinstance(o, (set, frozenset)):
+        return frozenset([_hashable(v) for v in o])
+    return o
+
+
+class Comparison(object):
+    """
+    An index of the resources in a list of blueprints.  Blueprints are
+    numbered by their position in the list and sets of blueprints are
+    represented as bitmaps, with bit `i` standing for blueprint `i`.
+    """
+
+    def __init__(self, blueprints):
+        self.blueprints = list(blueprints)
+        self.all = (1 << len(self.blueprints)) - 1
+
+        # Map each resource to a map of each of its values to the bitmap
+        # of the blueprints that have it.
+        self.index = {}
+        for i, b in enumerate(self.blueprints):
+            for resource, value in resources(b):
+                variants = self.index.setdefault(resource, {})
+                variants[value] = variants.get(value, 0) | 1 << i
+
+    def differences(self):
+        """
+        Generate a `(resource, variants)` pair for each resource that isn't
+        the same in every blueprint, sorted by type and name.  `variants`
+        maps each value of the resource to a bitmap as in `self.index`.
+        """
+        for resource in sorted(self.index.iterkeys(),
+                               key=lambda r: (TYPES.index(r[0]), r[1:])):
+            variants = self.index[resource]
+            if 1 == len(variants) and self.all in variants.itervalues():
+                continue
+            yield resource, variants
+
+    def reference(self, variants, base=None):
+        """
+        Return the bitmap of the blueprints that match the reference for a
+        resource with the given variants: those that agree with blueprint
+        number `base` or, if `base` is `None`, those with the most common
+        variant, counting not having the resource at all as a variant.
+        Ties go to the variant of the first blueprint involved.
+        """
+        bitmaps = variants.values() + [self.all & ~sum(variants.values())]
+        if base is not None:
+            for bitmap in bitmaps:
+                if bitmap & 1 << base:
+                    return bitmap
+        return max(bitmaps, key=lambda bitmap: (_count(bitmap),
+                                                -(bitmap & -bitmap)))
+
+    def row(self, variants, base=None):
+        """
+        Return a string with a character for each blueprint describing
+        whether it has the reference variant of a resource: `.` if it does,
+        `*` if it has another variant, `+` if it has the resource while the
+        reference doesn't, and `-` if it doesn't while the reference does.
+        """
+        reference = self.reference(variants, base)
+        present = sum(variants.values())
+        chars = []
+        for i in range(len(self.blueprints)):
+            bit = 1 << i
+            if reference & bit:
+                chars.append('.')
+            elif not present & bit:
+                chars.append('-')
+            elif reference & present:
+                chars.append('*')
+            else:
+                chars.append('+')
+        return ''.join(chars)
+
+    def summary(self, base=None):
+        """
+        Return a list with a `dict` for each blueprint counting, by type,
+        the resources on which it doesn't match the reference.
+        """
+        counts = [dict([(type, 0) for type in TYPES])
+                  for b in self.blueprints]
+        for resource, variants in self.differences():
+            reference = self.reference(variants, base)
+            for i in range(len(self.blueprints)):
+                if not reference & 1 << i:
+                    counts[i][resource[0]] += 1
+        return counts
+
+    def intersect(self, name, quorum=None):
+        """
+        Return a new blueprint by the given name with the resources that
+        at least `quorum` of the blueprints, or all of them if `quorum` is
+        `None`, have in common.  Files, services, and source tarballs are
+        in common if they're equal.  Packages are in common if they're
+        installed and keep the versions that are in common, if any.  When
+        several variants of a resource meet the quorum, the most common is
+        kept, with ties going to the variant of the first blueprint
+        involved.  Packages are dropped if their manager isn't kept.  Source
+        tarballs themselves aren't copied to the working directory.
+        """
+        if quorum is None:
+            quorum = len(self.blueprints)
+        b = blueprint.Blueprint(name)
+        for resource, variants in self.index.iteritems():
+            type = resource[0]
+
+            if 'package' == type:
+                if quorum > _count(sum(variants.values())):
+                    continue
+                manager, package = resource[1:]
+
+                # Packages with no versions in common are installed at
+                # any version, which is represented by no versions.
+                b.packages[manager][package]
+                counts = {}
+                for versions, bitmap in variants.iteritems():
+                    for version in versions:
+                        counts[version] = counts.get(version, 0) \
+                                        + _count(bitmap)
+                for version, count in counts.iteritems():
+                    if quorum <= count and version is not None:
+                        b.add_package(manager, package, version)
+                continue
+
+            bitmap = max(variants.itervalues(),
+                         key=lambda bitmap: (_count(bitmap), -_first(bitmap)))
+            if quorum > _count(bitmap):
+                continue
+            b2 = self.blueprints[_first(bitmap)]
+
+            if 'file' == type:
+                b.add_file(resource[1], **b2['files'][resource[1]].copy())
+
+            elif 'service' == type:
+                manager, service = resource[1:]
+                deps = b2['services'][manager][service]
+                b.add_service(manager, service)
+                b.add_service_file(manager, service, *deps.get('files', []))
+                for package_manager, packages in deps.get('packages',
+                                                          {}).iteritems():
+                    b.add_service_package(manager,
+                                          service,
+                                          package_manager,
+                                          *packages)
+                b.add_service_source(manager,
+                                     service,
+                                     *deps.get('sources', []))
+
+            elif 'source' == type:
+                b.add_source(resource[1], b2['sources'][resource[1]])
+
+        # Packages whose manager missed the quorum can't be reached from
+        # `apt`, `rpm`, or `yum` and would never be installed, so drop their
+        # whole subtree.
+        reachable = set([event[1] for event in walk.package_events(b)
+                         if 'before_packages' == event[0]])
+        for manager in b.packages.keys():
+            if manager not in reachable:
+                del b.packages[manager]
+
+        return b
+
+
+def _count(bitmap):
+    """
+    Return the number of bits set in the given bitmap.
+    """
+    return bin(bitmap).count('1')
+
+
+def _first(bitmap):
+    """
+    Return the number of the lowest bit set in the given bitmap.
+    """
+    return (bitmap & -bitmap).bit_length() - 1
@@ -14,19 +14,30 @@ from blueprint import util
 
 
 def cfn(b, relaxed=False):
+    callbacks, finish = visit(b, relaxed)
+    b.walk(**callbacks)
+    return finish()
+
+
+def visit(b, relaxed=False):
+    """
+    Return the callbacks that strip what CloudFormation can't use from a
+    copy of the blueprint as it's walked and a function that returns a
+    template of the copy after.
+    """
     b2 = copy.deepcopy(b)
     def file(pathname, f):
         if 'template' in f:
             logging.warning('file template {0} won\'t appear in generated '
                             'CloudFormation templates'.format(pathname))
             del b2.files[pathname]
+    def finish():
+        return Template(b2)
     if relaxed:
         def package(manager, package, version):
             b2.packages[manager][package] = []
-        b.walk(file=file, package=package)
-    else:
-        b.walk(file=file)
-    return Template(b2)
+        return dict(file=file, package=package), finish
+    return dict(file=file), finish
 
 
 class Template(dict):
@@ -67,6 +78,6 @@ class Template(dict):
         else:
             filename = '{0}.json'.format(self.name)
             f = codecs.open(filename, 'w', encoding='utf-8')
-        f.write(self.dumps())
+        util.json_dump(self, f)
         f.close()
         return filename
@@ -9,6 +9,7 @@ import logging
 import os
 import os.path
 import re
+import shutil
 import tarfile
 
 from blueprint import util
@@ -19,6 +20,16 @@ def chef(b, relaxed=False):
     """
     Generate Chef code.
     """
+    callbacks, finish = visit(b, relaxed)
+    b.walk(**callbacks)
+    return finish()
+
+
+def visit(b, relaxed=False):
+    """
+    Return the callbacks that add Chef resources to a cookbook as the
+    blueprint is walked and a function that returns the cookbook after.
+    """
     c = Cookbook(b.name, comment=b.DISCLAIMER)
 
     def source(dirname, filename, gen_content, url):
@@ -41,6 +52,8 @@ def chef(b, relaxed=False):
                    source=pathname[1:])
         if '.zip' == pathname[-4:]:
             c.execute('unzip "{0}"'.format(pathname), cwd=dirname)
+        elif '.gz' == pathname[-3:]:
+            c.execute('tar xzf "{0}"'.format(pathname), cwd=dirname)
         else:
             c.execute('tar xf "{0}"'.format(pathname), cwd=dirname)
 
@@ -188,13 +201,14 @@ def chef(b, relaxed=False):
                 'Chef::Provider::Service::Upstart')
         c.service(service, **kwargs)
 
-    b.walk(source=source,
-           file=file,
-           before_packages=before_packages,
-           package=package,
-           service=service)
+    def finish():
+        return c
 
-    return c
+    return dict(source=source,
+                file=file,
+                before_packages=before_packages,
+                package=package,
+                service=service), finish
 
 
 class Cookbook(object):
@@ -325,7 +339,13 @@ class Cookbook(object):
                 f = codecs.open(pathname, 'w', encoding='utf-8')
             else:
                 f = open(pathname, 'w')
-            f.write(resource.content)
+            if hasattr(resource.content, 'read'):
+                try:
+                    shutil.copyfileobj(resource.content, f)
+                finally:
+                    resource.content.close()
+            else:
+                f.write(resource.content)
             f.close()
         if gzip:
             filename = 'chef-{0}.tar.gz'.format(self.name)
@@ -10,6 +10,7 @@ import logging
 import os
 import os.path
 import re
+import shutil
 import tarfile
 
 from blueprint import util
@@ -20,6 +21,17 @@ def puppet(b, relaxed=False):
     """
     Generate Puppet code.
     """
+    callbacks, finish = visit(b, relaxed)
+    b.walk(**callbacks)
+    return finish()
+
+
+def visit(b, relaxed=False):
+    """
+    Return the callbacks that add Puppet resources to a manifest as the
+    blueprint is walked and a function that orders the manifest's classes
+    and returns it after.
+    """
     m = Manifest(b.name, comment=b.DISCLAIMER)
 
     # Set the default `PATH` for exec resources.
@@ -50,6 +62,10 @@ def puppet(b, relaxed=False):
             m['sources'].add(Exec('unzip {0}'.format(pathname),
                                   alias=dirname,
                                   cwd=dirname))
+        elif '.gz' == pathname[-3:]:
+            m['sources'].add(Exec('tar xzf {0}'.format(pathname),
+                                  alias=dirname,
+                                  cwd=dirname))
         else:
             m['sources'].add(Exec('tar xf {0}'.format(pathname),
                                   alias=dirname,
@@ -223,27 +239,29 @@ def puppet(b, relaxed=False):
             kwargs['provider'] = 'upstart'
         m['services'][manager].add(Service(service, **kwargs))
 
-    b.walk(source=source,
-           file=file,
-           before_packages=before_packages,
-           package=package,
-           service=service)
-    if 1 < len(deps):
-        m['packages'].dep(*[Class.ref(dep) for dep in deps])
+    def finish():
+        if 1 < len(deps):
+            m['packages'].dep(*[Class.ref(dep) for dep in deps])
 
-    # Strict ordering of classes.  Don't bother with services since
-    # they manage their own dependencies.
-    deps = []
-    if 0 < len(b.sources):
-        deps.append('sources')
-    if 0 < len(b.files):
-        deps.append('files')
-    if 0 < len(b.packages):
-        deps.append('packages')
-    if 1 < len(deps):
-        m.dep(*[Class.ref(dep) for dep in deps])
+        # Strict ordering of classes.  Don't bother with services since
+        # they manage their own dependencies.
+        deps2 = []
+        if 0 < len(b.sources):
+            deps2.append('sources')
+        if 0 < len(b.files):
+            deps2.append('files')
+        if 0 < len(b.packages):
+            deps2.append('packages')
+        if 1 < len(deps2):
+            m.dep(*[Class.ref(dep) for dep in deps2])
 
-    return m
+        return m
+
+    return dict(source=source,
+                file=file,
+                before_packages=before_packages,
+                package=package,
+                service=service), finish
 
 
 class Manifest(object):
@@ -403,7 +421,13 @@ class Manifest(object):
                 f = codecs.open(pathname, 'w', encoding='utf-8')
             else:
                 f = open(pathname, 'w')
-            f.write(content)
+            if hasattr(content, 'read'):
+                try:
+                    shutil.copyfileobj(content, f)
+                finally:
+                    content.close()
+            else:
+                f.write(content)
             f.close()
         if gzip:
             filename = 'puppet-{0}.tar.gz'.format(self.name)
@@ -10,6 +10,16 @@ def rules(b, relaxed=False):
     """
     Generated Blueprint rules.
     """
+    callbacks, finish = visit(b, relaxed)
+    b.walk(**callbacks)
+    return finish()
+
+
+def visit(b, relaxed=False):
+    """
+    Return the callbacks that generate Blueprint rules as the blueprint is
+    walked and a function that returns the rules once it has been.
+    """
     r = Rules(b.name, comment=b.DISCLAIMER)
 
     def source(dirname, filename, gen_content, url):
@@ -24,9 +34,13 @@ def rules(b, relaxed=False):
     def service(manager, service):
         r.append(':service:{0}/{1}'.format(manager, service))
 
-    b.walk(source=source, file=file, package=package, service=service)
+    def finish():
+        return r
 
-    return r
+    return dict(source=source,
+                file=file,
+                package=package,
+                service=service), finish
 
 
 class Rules(list):
@@ -11,14 +11,30 @@ import re
 from shutil import copyfile
 import tarfile
 
+from blueprint import chunks
 from blueprint import git
 from blueprint import util
+from blueprint import walk
 
 
 def sh(b, relaxed=False, server='https://devstructure.com', secret=None):
     """
     Generate shell code.
     """
+    callbacks, finish = visit(b, relaxed, server, secret)
+    b.walk(**callbacks)
+    return finish()
+
+
+def visit(b,
+          relaxed=False,
+          server='https://devstructure.com',
+          secret=None):
+    """
+    Return the callbacks that add shell code to a script as the blueprint is
+    walked and a function that returns the script after.  Services are
+    walked first, on their own, to learn what each resource restarts.
+    """
     s = Script(b.name, comment=b.DISCLAIMER)
 
     # Build an inverted index (lookup table, like in hardware, hence the name)
@@ -32,9 +48,10 @@ def sh(b, relaxed=False, server='https://devstructure.com', secret=None):
         lut['packages'][package_manager][package].add((manager, service))
     def service_source(manager, service, dirname):
         lut['sources'][dirname].add((manager, service))
-    b.walk(service_file=service_file,
-           service_package=service_package,
-           service_source=service_source)
+    walk.walk_services(b,
+                       service_file=service_file,
+                       service_package=service_package,
+                       service_source=service_source)
 
     commit = git.rev_parse(b.name)
     tree = None if commit is None else git.tree(commit)
@@ -45,6 +62,7 @@ def sh(b, relaxed=False, server='https://devstructure.com', secret=None):
         if dirname in lut['sources']:
             s.add('MD5SUM="$(find "{0}" -printf %T@\\\\n | md5sum)"',
                   args=(dirname,))
+        tar = 'tar xzf' if '.gz' == filename[-3:] else 'tar xf'
         if url is not None:
             s.add_list(('curl -o "{0}" "{1}"',),
                        ('wget -O "{0}" "{1}"',),
@@ -53,16 +71,19 @@ def sh(b, relaxed=False, server='https://devstructure.com', secret=None):
             if '.zip' == pathname[-4:]:
                 s.add('unzip "{0}" -d "{1}"', args=(filename, dirname))
             else:
-                s.add('mkdir -p "{1}" && tar xf "{0}" -C "{1}"', args=(filename, dirname))
+                s.add('mkdir -p "{1}" && {2} "{0}" -C "{1}"',
+                      args=(filename, dirname, tar))
         elif secret is not None:
             s.add_list(('curl -O "{0}/{1}/{2}/{3}"',),
                        ('wget "{0}/{1}/{2}/{3}"',),
                        args=(server, secret, b.name, filename),
                        operator='||')
-            s.add('mkdir -p "{1}" && tar xf "{0}" -C "{1}"', args=(filename, dirname))
+            s.add('mkdir -p "{1}" && {2} "{0}" -C "{1}"',
+                  args=(filename, dirname, tar))
         elif gen_content is not None:
-            s.add('mkdir -p "{1}" && tar xf "{0}" -C "{1}"', args=(filename, dirname))
-            s.add_source(filename, git.blob(tree, filename))
+            s.add('mkdir -p "{1}" && {2} "{0}" -C "{1}"',
+                  args=(filename, dirname, tar))
+            s.add_source(filename, chunks.blobs(tree, filename))
         for manager, service in lut['sources'][dirname]:
             s.add_list(('[ "$MD5SUM" != "$(find "{0}" -printf %T@\\\\n '
                         '| md5sum)" ]',),
@@ -179,13 +200,14 @@ def sh(b, relaxed=False, server='https://devstructure.com', secret=None):
     def service(manager, service):
         s.add(manager(service))
 
-    b.walk(source=source,
-           file=file,
-           before_packages=before_packages,
-           package=package,
-           service=service)
+    def finish():
+        return s
 
-    return s
+    return dict(source=source,
+                file=file,
+                before_packages=before_packages,
+                package=package,
+                service=service), finish
 
 
 def command(*commands, **kwargs):
@@ -271,12 +293,13 @@ class Script(object):
         """
         self.out.append(command_list(*args, **kwargs))
 
-    def add_source(self, filename, blob):
+    def add_source(self, filename, blobs):
         """
-        Add a reference to a source tarball to the `Script`.  It will be
-        placed in the output directory/tarball later via `git-cat-file`(1).
+        Add a reference to a source tarball, by the blobs that make it up,
+        to the `Script`.  It will be placed in the output directory/tarball
+        later via `git-cat-file`(1).
         """
-        self.sources[filename] = blob
+        self.sources[filename] = blobs
 
     def dumps(self):
         """
@@ -331,8 +354,8 @@ class Script(object):
         f.close()
 
         # Bring source tarballs along.
-        for filename2, blob in sorted(self.sources.iteritems()):
-            git.cat_file(blob, os.path.join(self.name, filename2))
+        for filename2, blobs in sorted(self.sources.iteritems()):
+            chunks.cat_file(blobs, os.path.join(self.name, filename2))
 
         # Possibly gzip the result.
         if gzip and (0 < len(self.sources) or self.templates):
@@ -1,16 +1,131 @@
+import atexit
 import logging
 import os
 import os.path
+import re
 import subprocess
 import sys
+import tempfile
 
+from blueprint import objects
 from blueprint import util
 
 
+# Characters that can't appear as they are in a pathname read from standard
+# input one per line.
+pattern_unsafe = re.compile(r'[\x00-\x1f"\\\x7f]')
+
+
 class GitError(EnvironmentError):
     pass
 
 
+class CatFile(object):
+    """
+    A long-lived git-cat-file(1) co-process that answers requests for any
+    number of objects one line at a time.  It's started on first use,
+    restarted in forked children and if the repository moves, and closed
+    when Python exits.
+    """
+
+    def __init__(self, option):
+        self.option = option
+        self.p = None
+        self.pid = None
+        self.repo = None
+
+    def process(self):
+        """
+        Return the co-process, starting it if necessary.
+        """
+        dirname = repo()
+        if self.p is not None and os.getpid() == self.pid:
+            if dirname == self.repo:
+                return self.p
+            self.close()
+        try:
+            self.p = subprocess.Popen(['git',
+                                       '--git-dir', dirname,
+                                       'cat-file',
+                                       self.option],
+                                      close_fds=True,
+                                      preexec_fn=unroot,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        except OSError:
+            logging.error('git not found on PATH - exiting')
+            sys.exit(1)
+        self.pid = os.getpid()
+        self.repo = dirname
+        return self.p
+
+    def request(self, name):
+        """
+        Request the named object.  Return its SHA, type, and size or `None`
+        if it doesn't exist.  With `--batch`, its content follows.
+        """
+        p = self.process()
+        try:
+            p.stdin.write('{0}\n'.format(name))
+            p.stdin.flush()
+        except IOError:
+            self.p = None
+            raise GitError(p.wait())
+        line = p.stdout.readline()
+        if '' == line:
+            self.p = None
+            raise GitError(p.wait())
+        fields = line.split()
+        if 3 != len(fields) or not fields[2].isdigit():
+            return None
+        return fields[0], fields[1], int(fields[2])
+
+    def read(self, name):
+        """
+        Return the type and content of the named object or `None`.
+        """
+        header = self.request(name)
+        if header is None:
+            return None
+        sha, type, size = header
+        content = self.p.stdout.read(size)
+        self.p.stdout.read(1)
+        return type, content
+
+    def copy(self, name, f):
+        """
+        Write the content of the named object to the open file `f` without
+        holding all of it in memory.  Return its type or `None`.
+        """
+        header = self.request(name)
+        if header is None:
+            return None
+        sha, type, size = header
+        while 0 < size:
+            buf = self.p.stdout.read(min(size, 65536))
+            f.write(buf)
+            size -= len(buf)
+        self.p.stdout.read(1)
+        return type
+
+    def close(self):
+        """
+        Close the co-process, if it's running in this process.
+        """
+        if self.p is not None and os.getpid() == self.pid:
+            self.p.stdin.close()
+            self.p.wait()
+        self.p = None
+
+
+# All object reads that `blueprint.objects` can't handle in-process share
+# these two co-processes.
+_batch = CatFile('--batch')
+_batch_check = CatFile('--batch-check')
+atexit.register(_batch.close)
+atexit.register(_batch_check.close)
+
+
 def unroot():
     """
     Drop privileges gained through sudo(1).
@@ -95,74 +210,256 @@ def rev_parse(refname):
     """
     Return the referenced commit or None.
     """
-    status, stdout = git('rev-parse', '-q', '--verify', refname,
-                         raise_exc=False)
-    if 0 != status:
+    sha = objects.ref(repo(), refname)
+    if sha is not None:
+        return sha
+    try:
+        header = _batch_check.request(refname)
+    except GitError:
         return None
-    return stdout.rstrip()
+    if header is None:
+        return None
+    return header[0]
+
+
+# Trees by commit SHA.  Commits are immutable so these never go stale.
+_commits = {}
 
 
 def tree(commit):
     """
     Return the tree in the given commit or None.
     """
-    status, stdout = git('show', '--pretty=format:%T', commit)
-    if 0 != status:
-        return None
-    return stdout[0:40]
+    if commit not in _commits:
+        object = objects.read(repo(), commit)
+        if object is not None and 'commit' == object[0]:
+            _commits[commit] = object[1][5:45]
+        else:
+            header = _batch_check.request('{0}^{{tree}}'.format(commit))
+            if header is None:
+                return None
+            _commits[commit] = header[0]
+    return _commits[commit]
 
 
-def ls_tree(tree, dirname=[]):
+def _read(name):
     """
-    Generate all the pathnames in the given tree.
+    Return the type and content of the named object or None, read in-process
+    if `blueprint.objects` can, otherwise via git-cat-file(1).
+    """
+    object = objects.read(repo(), name)
+    if object is None:
+        object = _batch.read(name)
+    return object
+
+
+def _entries(tree):
+    """
+    Generate the mode, filename, and SHA of each entry in the given tree,
+    not including its subtrees.
+    """
+    object = _read(tree)
+    if object is None:
+        return
+    content = object[1]
+    i = 0
+    while i < len(content):
+        j = content.index('\0', i)
+        mode, filename = content[i:j].split(' ', 1)
+        sha = content[j + 1:j + 21].encode('hex')
+        i = j + 21
+        yield mode, filename, sha
+
+
+def _ls_tree(tree, dirname=[]):
+    """
+    Generate all the entries in the given tree and its subtrees.
     """
-    status, stdout = git('ls-tree', tree)
-    for line in stdout.splitlines():
-        mode, type, sha, filename = line.split()
-        if 'tree' == type:
-            for entry in ls_tree(sha, dirname + [filename]):
+    for mode, filename, sha in _entries(tree):
+        if '40000' == mode:
+            for entry in _ls_tree(sha, dirname + [filename]):
                 yield entry
         else:
-            yield mode, type, sha, os.path.join(*dirname + [filename])
+            type = 'commit' if '160000' == mode else 'blob'
+            yield mode.zfill(6), type, sha, os.path.join(*dirname + [filename])
+
+
+# Listings of trees and maps of their pathnames to modes and SHAs, by tree
+# SHA.  Trees are immutable so these never go stale.
+_trees = {}
+
+
+def _tree(tree):
+    """
+    Return the listing and pathname map of the given tree, reading it from
+    Git's object store the first time it's needed.
+    """
+    if tree not in _trees:
+        entries = list(_ls_tree(tree))
+        _trees[tree] = (entries,
+                        dict([(pathname, (mode, sha))
+                              for mode, type, sha, pathname in entries]))
+    return _trees[tree]
+
+
+def ls_tree(tree):
+    """
+    Generate all the pathnames in the given tree.
+    """
+    return iter(_tree(tree)[0])
 
 
 def blob(tree, pathname):
     """
-    Return the SHA of the blob by the given name in the given tree.
+    Return the SHA of the blob by the given name in the given tree.  Unless
+    the whole tree has been listed already, only the trees along the way
+    are read, so finding a top-level blob doesn't read every subtree.
+    """
+    if tree in _trees:
+        entry = _trees[tree][1].get(pathname)
+        if entry is None:
+            return None
+        return entry[1]
+    filenames = pathname.split('/')
+    for filename in filenames[:-1]:
+        entry = ls_level(tree).get(filename)
+        if entry is None or '40000' != entry[0]:
+            return None
+        tree = entry[1]
+    entry = ls_level(tree).get(filenames[-1])
+    if entry is None or '40000' == entry[0]:
+        return None
+    return entry[1]
+
+
+# Maps of the filenames in a single tree to their modes and SHAs, by tree
+# SHA.  Trees are immutable so these never go stale.
+_levels = {}
+
+
+def ls_level(tree):
+    """
+    Return the map of filenames in the given tree, not including its
+    subtrees, to their modes and SHAs.
     """
-    for mode, type, sha, pathname2 in ls_tree(tree):
-        if pathname == pathname2:
-            return sha
-    return None
+    if tree not in _levels:
+        _levels[tree] = dict([(filename, (mode, sha))
+                              for mode, filename, sha in _entries(tree)])
+    return _levels[tree]
 
 
 def content(blob):
     """
     Return the content of the given blob.
     """
-    status, stdout = git('show', blob)
-    if 0 != status:
+    object = _read(blob)
+    if object is None:
         return None
-    return stdout
+    return object[1]
 
 
 def cat_file(blob, pathname=None):
     """
     If `pathname` is `None`, return an open file handle to the blob in
-    Git's object store, otherwise stream the blob to `pathname`, all via
-    the git-cat-file(1) command.
+    Git's object store, otherwise write the blob to `pathname`.  Either way
+    the blob is streamed, by git-cat-file(1) if `blueprint.objects` can't.
     """
-    args = git_args() + ['cat-file', 'blob', blob]
+    pieces = objects.stream(repo(), blob)
     if pathname is None:
-        return subprocess.Popen(args,
-                                close_fds=True,
-                                preexec_fn=unroot,
-                                stdout=subprocess.PIPE).stdout
+        if pieces is None:
+            return subprocess.Popen(git_args() + ['cat-file', 'blob', blob],
+                                    close_fds=True,
+                                    preexec_fn=unroot,
+                                    stdout=subprocess.PIPE).stdout
+        f = tempfile.TemporaryFile()
+    else:
+        f = open(pathname, 'w')
+    if pieces is None:
+        _batch.copy(blob, f)
     else:
-        subprocess.Popen(args,
+        for piece in pieces:
+            f.write(piece)
+    if pathname is None:
+        f.seek(0)
+        return f
+    f.close()
+
+
+def stream(blob):
+    """
+    Generate the content of the given blob in pieces of bounded size, so
+    even the largest blobs needn't be held in memory.
+    """
+    pieces = objects.stream(repo(), blob)
+    if pieces is None:
+        p = subprocess.Popen(git_args() + ['cat-file', 'blob', blob],
+                             close_fds=True,
+                             preexec_fn=unroot,
+                             stdout=subprocess.PIPE)
+        pieces = iter(lambda: p.stdout.read(objects.BUFSIZE), '')
+        for piece in pieces:
+            yield piece
+        if 0 != p.wait():
+            raise GitError(p.returncode)
+    else:
+        for piece in pieces:
+            yield piece
+
+
+def hash_object(content):
+    """
+    Write the given content to Git's object store and return its SHA.  The
+    content may be a string or an open file, which git-hash-object(1) reads
+    directly from its current position.
+    """
+    if isinstance(content, basestring):
+        status, stdout = git('hash-object', '-w', '--stdin', stdin=content)
+        return stdout.rstrip()
+    p = subprocess.Popen(git_args() + ['hash-object', '-w', '--stdin'],
                          close_fds=True,
                          preexec_fn=unroot,
-                         stdout=open(pathname, 'w')).communicate()
+                         stdin=content,
+                         stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if 0 != p.returncode:
+        raise GitError(p.returncode)
+    return stdout.rstrip()
+
+
+def hash_objects(pathnames):
+    """
+    Write the named files to Git's object store and return a list of their
+    SHAs in the same order, all in one git-hash-object(1) command.
+    """
+    if 0 == len(pathnames):
+        return []
+    status, stdout = git('hash-object', '-w', '--stdin-paths',
+                         stdin=''.join(['{0}\n'.format(_quote(
+                                            os.path.abspath(pathname)))
+                                        for pathname in pathnames]))
+    return stdout.split()
+
+
+def _quote(pathname):
+    """
+    Return the given pathname as git-hash-object(1) reads it from standard
+    input: as it is unless it contains characters that would end the line
+    or be taken for quoting, otherwise quoted in C style.
+    """
+    if not pattern_unsafe.search(pathname):
+        return pathname
+    return '"{0}"'.format(pattern_unsafe.sub(
+        lambda match: '\\{0:03o}'.format(ord(match.group(0))), pathname))
+
+def update_index(entries):
+    """
+    Replace the contents of the index with the given `(mode, sha, pathname)`
+    entries, all of which must already be in Git's object store.
+    """
+    git('read-tree', '--empty')
+    git('update-index', '--add', '-z', '--index-info',
+        stdin=''.join(['{0} {1}\t{2}\0'.format(mode, sha, pathname)
+                       for mode, sha, pathname in entries]))
 
 
 def write_tree():
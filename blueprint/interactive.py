@@ -2,6 +2,7 @@
 Interactively walk blueprints.
 """
 
+import chunks
 import git
 import walk as walklib
 
@@ -18,7 +19,7 @@ def walk(b, choose):
         b_chosen = choose()
         if b_chosen is None:
             return
-        b_chosen.add_file(pathname, **f)
+        b_chosen.add_file(pathname, **f.copy())
 
     def package(manager, package, version):
         print('{0} {1} {2}'.format(manager, package, version))
@@ -63,8 +64,7 @@ def walk(b, choose):
         if url is not None:
             print('{0} {1}'.format(dirname, url))
         elif gen_content is not None:
-            blob = git.blob(tree, filename)
-            git.cat_file(blob, filename)
+            chunks.cat_file(chunks.blobs(tree, filename), filename)
             print('{0} {1}'.format(dirname, filename))
         b_chosen = choose()
         if b_chosen is None:
@@ -1,8 +1,10 @@
 import logging
 import sys
+import tempfile
 
 from blueprint import Blueprint
 from blueprint import cfg
+from blueprint import chunks
 from blueprint import git
 import http
 
@@ -54,10 +56,14 @@ def push(server, secret, b):
     Push a blueprint to the secret and its name on the configured server.
     """
 
+    f = tempfile.TemporaryFile()
+    b.dump(f)
+    f.seek(0)
     r = http.put('/{0}/{1}'.format(secret, b.name),
-                 b.dumps(),
+                 f,
                  {'Content-Type': 'application/json'},
                  server=server)
+    f.close()
     if 202 == r.status:
         pass
     elif 400 == r.status:
@@ -76,13 +82,17 @@ def push(server, secret, b):
     elif b._commit is not None:
         tree = git.tree(b._commit)
         for dirname, filename in sorted(b.sources.iteritems()):
-            blob = git.blob(tree, filename)
-            content = git.content(blob)
+            f = chunks.cat_file(chunks.blobs(tree, filename))
             logging.info('storing source tarballs - this may take a while')
+            if '.gz' == filename[-3:]:
+                content_type = 'application/x-gzip'
+            else:
+                content_type = 'application/x-tar'
             r = http.put('/{0}/{1}/{2}'.format(secret, b.name, filename),
-                         content,
-                         {'Content-Type': 'application/x-tar'},
+                         f,
+                         {'Content-Type': content_type},
                          server=server)
+            f.close()
             if 202 == r.status:
                 pass
             elif 400 == r.status:
@@ -163,7 +163,9 @@ def put_blueprint(secret, name):
     if b is not None and b is not False:
         for filename in set(b.sources.itervalues()) - \
                         set(request.json.get('sources', {}).itervalues()):
-            backend.delete_tarball(secret, name, filename[0:-4])
+            sha, ext = filename[0:40], filename[40:]
+            if ext in ('.tar', '.tar.gz'):
+                backend.delete_tarball(secret, name, sha, ext)
 
     # Store the blueprint JSON in S3.
     if not backend.put_blueprint(secret, name, request.data):
@@ -174,14 +176,17 @@ def put_blueprint(secret, name):
                            content_type='text/plain')
 
 
-@app.route('/<secret>/<name>/<sha>.tar', methods=['GET'])
-def get_tarball(secret, name, sha):
+@app.route('/<secret>/<name>/<sha>.tar', methods=['GET'],
+           defaults={'ext': '.tar'})
+@app.route('/<secret>/<name>/<sha>.tar.gz', methods=['GET'],
+           defaults={'ext': '.tar.gz'})
+def get_tarball(secret, name, sha, ext):
     validate_secret(secret)
     validate_name(name)
     sha = sha.lower()
     validate_sha(sha)
 
-    content_length = backend.head_tarball(secret, name, sha)
+    content_length = backend.head_tarball(secret, name, sha, ext)
     if content_length is None:
         abort(404)
 
@@ -190,11 +195,14 @@ def get_tarball(secret, name, sha):
     librato.count('blueprint-io-server.bandwidth.out', content_length)
     statsd.update('blueprint-io-server.bandwidth.out', content_length)
 
-    return redirect(backend.url_for_tarball(secret, name, sha), code=301)
+    return redirect(backend.url_for_tarball(secret, name, sha, ext), code=301)
 
 
-@app.route('/<secret>/<name>/<sha>.tar', methods=['PUT'])
-def put_tarball(secret, name, sha):
+@app.route('/<secret>/<name>/<sha>.tar', methods=['PUT'],
+           defaults={'ext': '.tar'})
+@app.route('/<secret>/<name>/<sha>.tar.gz', methods=['PUT'],
+           defaults={'ext': '.tar.gz'})
+def put_tarball(secret, name, sha, ext):
     validate_secret(secret)
     validate_name(name)
     sha = sha.lower()
@@ -214,11 +222,11 @@ def put_tarball(secret, name, sha):
         abort(404)
     elif b is False:
         abort(502)
-    if '{0}.tar'.format(sha) not in b.sources.itervalues():
+    if '{0}{1}'.format(sha, ext) not in b.sources.itervalues():
         abort(400)
 
     # Store the tarball in S3.
-    if not backend.put_tarball(secret, name, sha, request.data):
+    if not backend.put_tarball(secret, name, sha, request.data, ext):
         abort(502)
 
     return MeteredResponse(response='',
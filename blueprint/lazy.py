@@ -0,0 +1,211 @@
+"""
+Files whose content is read from the local Git repository only when it's
+needed.  When `blobs` is enabled in `blueprint.cfg`(5), the content of each
+file is stored as a blob at `files/<pathname>` in the tree and
+`blueprint.json` references it by its SHA as `blob` in place of `content`.
+Commands that only need names and metadata, like `blueprint-show-files`(1),
+never read the content at all.
+"""
+
+import os
+import os.path
+import shutil
+
+import git
+
+
+class File(dict):
+    """
+    A file resource whose `content` is read from the given blob the first
+    time anything depends on it.  Metadata is available without reading the
+    content.  Only Python-level access is intercepted, so copy a `File`
+    with `f.copy()` rather than `dict(f)` or `**f`.
+    """
+
+    def __init__(self, blob, *args, **kwargs):
+        super(File, self).__init__(*args, **kwargs)
+        self.blob = blob
+
+    def load(self):
+        """
+        Read this file's content from its blob if it hasn't been already.
+        """
+        if self.blob is not None:
+            dict.__setitem__(self,
+                             'content',
+                             git.content(self.blob).decode('utf_8'))
+            self.blob = None
+
+    def reference(self):
+        """
+        Return a plain `dict` of this file as `blueprint.json` references
+        it, which is only possible before its content has been read.
+        """
+        f = dict(dict.iteritems(self))
+        f['blob'] = self.blob
+        return f
+
+    def __contains__(self, key):
+        if 'content' == key and self.blob is not None:
+            return True
+        return dict.__contains__(self, key)
+    has_key = __contains__
+
+    def __delitem__(self, key):
+        if 'content' == key and self.blob is not None:
+            self.blob = None
+            return
+        dict.__delitem__(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+
+        # Equal blobs have equal content, so files that both reference
+        # blobs are compared without reading either.
+        if isinstance(other, File) \
+        and self.blob is not None and other.blob is not None:
+            return self.blob == other.blob and dict.__eq__(self, other)
+
+        self.load()
+        if isinstance(other, File):
+            other.load()
+        return dict.__eq__(self, other)
+
+    def __getitem__(self, key):
+        if 'content' == key:
+            self.load()
+        return dict.__getitem__(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return dict.__len__(self) + (0 if self.blob is None else 1)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    def __repr__(self):
+        self.load()
+        return dict.__repr__(self)
+
+    def __setitem__(self, key, value):
+        if 'content' == key:
+            self.blob = None
+        dict.__setitem__(self, key, value)
+
+    def copy(self):
+        return dict(self.items())
+
+    def get(self, key, default=None):
+        if 'content' == key:
+            self.load()
+        return dict.get(self, key, default)
+
+    def items(self):
+        self.load()
+        return dict.items(self)
+
+    def iteritems(self):
+        self.load()
+        return dict.iteritems(self)
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        self.load()
+        return dict.itervalues(self)
+
+    def keys(self):
+        keys = dict.keys(self)
+        if self.blob is not None:
+            keys.append('content')
+        return keys
+
+    def pop(self, *args):
+        self.load()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.load()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if 'content' == key:
+            self.load()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self.load()
+        dict.update(self, *args, **kwargs)
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+
+def file(f):
+    """
+    Return a file resource from the plain `dict` `f`, as parsed from
+    `blueprint.json`: a `File` if it references a blob, otherwise a copy
+    of `f`.
+    """
+    f = dict(f)
+    if 'blob' in f and 'content' not in f:
+        return File(f.pop('blob'), f)
+    return f
+
+
+def write(files):
+    """
+    Store the content of each of the given `{pathname: file}` files in
+    Git's object store, all in one command, and return a `dict` of the
+    files as `blueprint.json` references them and a list of
+    `(mode, sha, pathname)` tree entries for their blobs.  Files that
+    reference blobs already are not read.  Files without content are
+    unchanged.
+    """
+    files2, entries, pathnames, contents = {}, [], [], []
+    for pathname, f in files.iteritems():
+        if isinstance(f, File) and f.blob is not None:
+            files2[pathname] = f.reference()
+            entries.append(('100644', f.blob, 'files' + pathname))
+        elif isinstance(f.get('content'), basestring):
+            pathnames.append(pathname)
+            contents.append(f['content'])
+        else:
+            files2[pathname] = f
+
+    # Write content to be stored in Git into the working directory first
+    # so it can be stored by one git-hash-object(1).
+    if 0 < len(pathnames):
+        dirname = 'blueprint-files'
+        os.mkdir(dirname)
+        try:
+            filenames = []
+            for i, content in enumerate(contents):
+                filename = os.path.join(dirname, '{0:08d}'.format(i))
+                f = open(filename, 'w')
+                if isinstance(content, unicode):
+                    content = content.encode('utf_8')
+                f.write(content)
+                f.close()
+                filenames.append(filename)
+            shas = git.hash_objects(filenames)
+        finally:
+            shutil.rmtree(dirname)
+        for pathname, sha in zip(pathnames, shas):
+            f = files[pathname].copy()
+            del f['content']
+            f['blob'] = sha
+            files2[pathname] = f
+            entries.append(('100644', sha, 'files' + pathname))
+
+    return files2, entries
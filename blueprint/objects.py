@@ -0,0 +1,329 @@
+"""
+Read objects and references from the blueprints Git repository without
+running Git.  Loose objects are inflated with `zlib` and packed objects are
+found by binary search of their pack's `.idx` file and resolved through any
+chain of deltas, with both files `mmap`ped.  Anything this module can't read
+comes back as `None` so `blueprint.git` can fall back to git-cat-file(1).
+"""
+
+import mmap
+import os
+import os.path
+import re
+import struct
+import zlib
+
+
+# Object types as they're numbered in packfiles.
+TYPES = {1: 'commit',
+         2: 'tree',
+         3: 'blob',
+         4: 'tag'}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+# The most compressed data read or decompressed data generated at once.
+BUFSIZE = 65536
+
+pattern_sha = re.compile(r'^[0-9a-f]{40}$')
+
+
+class Pack(object):
+    """
+    A packfile and its version 2 index.
+    """
+
+    def __init__(self, pathname):
+        """
+        Open the index at `pathname` and the packfile beside it.
+        """
+        self.idx = _mmap(pathname)
+        if '\xfftOc\x00\x00\x00\x02' != self.idx[0:8]:
+            raise ValueError('unsupported pack index {0}'.format(pathname))
+        self.fanout = struct.unpack('>256I', self.idx[8:1032])
+        self.count = self.fanout[255]
+        self.pack = _mmap('{0}.pack'.format(pathname[:-4]))
+
+    def offset(self, binsha):
+        """
+        Return the offset of the object with the given binary SHA in the
+        packfile or `None`.
+        """
+        first = ord(binsha[0])
+        lo = 0 if 0 == first else self.fanout[first - 1]
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            binsha2 = self.idx[1032 + 20 * mid:1052 + 20 * mid]
+            if binsha2 < binsha:
+                lo = mid + 1
+            elif binsha < binsha2:
+                hi = mid
+            else:
+                i = 1032 + 24 * self.count + 4 * mid
+                offset = struct.unpack('>I', self.idx[i:i + 4])[0]
+                if offset & 0x80000000:
+                    i = 1032 + 28 * self.count + 8 * (offset & 0x7fffffff)
+                    offset = struct.unpack('>Q', self.idx[i:i + 8])[0]
+                return offset
+        return None
+
+    def header(self, offset):
+        """
+        Return the type number and size of the object at the given offset in
+        the packfile and the offset just past its header.
+        """
+        c = ord(self.pack[offset])
+        type, size, shift = (c >> 4) & 7, c & 15, 4
+        offset += 1
+        while c & 0x80:
+            c = ord(self.pack[offset])
+            size |= (c & 0x7f) << shift
+            shift += 7
+            offset += 1
+        return type, size, offset
+
+    def read(self, offset, dirname):
+        """
+        Return the type and content of the object at the given offset in
+        the packfile.  Bases of `REF_DELTA` objects are read from anywhere
+        in the repository at `dirname`.
+        """
+        start = offset
+        type, size, offset = self.header(offset)
+
+        if OFS_DELTA == type:
+            c = ord(self.pack[offset])
+            distance = c & 0x7f
+            offset2 = offset + 1
+            while c & 0x80:
+                c = ord(self.pack[offset2])
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+                offset2 += 1
+            base = self.read(start - distance, dirname)
+            return base[0], _patch(base[1], self.inflate(offset2, size))
+
+        if REF_DELTA == type:
+            base = read(dirname, self.pack[offset:offset + 20].encode('hex'))
+            if base is None:
+                raise ValueError('missing delta base')
+            return base[0], _patch(base[1], self.inflate(offset + 20, size))
+
+        return TYPES[type], self.inflate(offset, size)
+
+    def bufs(self, offset):
+        """
+        Generate the packfile's content from the given offset onward.
+        """
+        while offset < len(self.pack):
+            yield self.pack[offset:offset + BUFSIZE]
+            offset += BUFSIZE
+
+    def inflate(self, offset, size):
+        """
+        Inflate `size` bytes from the zlib stream at the given offset.
+        """
+        content = ''.join(_inflate(self.bufs(offset)))
+        if size != len(content):
+            raise ValueError('corrupt packed object')
+        return content
+
+
+# Packs by repository and then by index pathname.  Packs that can't be read
+# are stored as `None` so they aren't tried again.
+_packs = {}
+
+
+def _mmap(pathname):
+    f = open(pathname, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def _inflate(bufs):
+    """
+    Generate the content of the zlib stream read from the iterable `bufs`
+    in pieces of at most `BUFSIZE` bytes.  Anything after the end of the
+    stream is ignored.
+    """
+    d = zlib.decompressobj()
+    for buf in bufs:
+
+        # Python 2 doesn't clear `unconsumed_tail` once the stream ends
+        # so `unused_data` is the only reliable sign of the end.
+        while '' != buf and '' == d.unused_data:
+            piece = d.decompress(buf, BUFSIZE)
+            if '' != piece:
+                yield piece
+            buf = d.unconsumed_tail
+        if '' != d.unused_data:
+            break
+    piece = d.flush()
+    if '' != piece:
+        yield piece
+
+
+def _loose(f):
+    """
+    Generate the content of the loose object open as `f` in pieces, after
+    its type and size, which come first as a string.  Close `f` when done.
+    """
+    try:
+        pieces = _inflate(iter(lambda: f.read(BUFSIZE), ''))
+        header, piece = pieces.next().split('\0', 1)
+        yield header
+        if '' != piece:
+            yield piece
+        for piece in pieces:
+            yield piece
+    finally:
+        f.close()
+
+
+def _patch(base, delta):
+    """
+    Apply a Git delta to `base`.
+    """
+    i = 0
+    for _ in range(2):
+        while ord(delta[i]) & 0x80:
+            i += 1
+        i += 1
+    content = []
+    while i < len(delta):
+        c = ord(delta[i])
+        i += 1
+        if c & 0x80:
+            offset = size = 0
+            for shift in range(4):
+                if c & (1 << shift):
+                    offset |= ord(delta[i]) << (8 * shift)
+                    i += 1
+            for shift in range(3):
+                if c & (0x10 << shift):
+                    size |= ord(delta[i]) << (8 * shift)
+                    i += 1
+            content.append(base[offset:offset + (size or 0x10000)])
+        elif c:
+            content.append(delta[i:i + c])
+            i += c
+        else:
+            raise ValueError('invalid delta opcode')
+    return ''.join(content)
+
+
+def packs(dirname):
+    """
+    Return the packs in the repository at `dirname`, opening any that are
+    new since the last call.
+    """
+    packs = _packs.setdefault(dirname, {})
+    pack_dirname = os.path.join(dirname, 'objects', 'pack')
+    try:
+        filenames = os.listdir(pack_dirname)
+    except OSError:
+        return []
+    for filename in sorted(filenames):
+        if not filename.endswith('.idx'):
+            continue
+        pathname = os.path.join(pack_dirname, filename)
+        if pathname not in packs:
+            try:
+                packs[pathname] = Pack(pathname)
+            except (EnvironmentError, ValueError, struct.error):
+                packs[pathname] = None
+    return [pack for pack in packs.itervalues() if pack is not None]
+
+
+def read(dirname, sha):
+    """
+    Return the type and content of the object in the repository at `dirname`
+    by the given SHA or `None`.
+    """
+    if not isinstance(sha, basestring) or not pattern_sha.match(sha):
+        return None
+    try:
+        f = open(os.path.join(dirname, 'objects', sha[0:2], sha[2:]), 'rb')
+    except IOError:
+        pass
+    else:
+        try:
+            pieces = _loose(f)
+            type, size = pieces.next().split(' ')
+            content = ''.join(pieces)
+            if int(size) != len(content):
+                return None
+            return type, content
+        except (EnvironmentError, StopIteration, ValueError, zlib.error):
+            return None
+    binsha = sha.decode('hex')
+    for pack in packs(dirname):
+        try:
+            offset = pack.offset(binsha)
+            if offset is not None:
+                return pack.read(offset, dirname)
+        except (IndexError, KeyError, ValueError, struct.error, zlib.error):
+            return None
+    return None
+
+
+def stream(dirname, sha):
+    """
+    Return a generator of the content of the object in the repository at
+    `dirname` by the given SHA in pieces of at most `BUFSIZE` bytes or
+    `None`.  Objects stored as deltas aren't streamed.
+    """
+    if not isinstance(sha, basestring) or not pattern_sha.match(sha):
+        return None
+    try:
+        f = open(os.path.join(dirname, 'objects', sha[0:2], sha[2:]), 'rb')
+    except IOError:
+        pass
+    else:
+        try:
+            pieces = _loose(f)
+            pieces.next()
+            return pieces
+        except (EnvironmentError, StopIteration, ValueError, zlib.error):
+            return None
+    binsha = sha.decode('hex')
+    for pack in packs(dirname):
+        try:
+            offset = pack.offset(binsha)
+            if offset is None:
+                continue
+            type, size, offset = pack.header(offset)
+        except (IndexError, struct.error):
+            return None
+        if type not in TYPES:
+            return None
+        return _inflate(pack.bufs(offset))
+    return None
+
+
+def ref(dirname, refname):
+    """
+    Return the SHA that the fully-qualified `refname` points to in the
+    repository at `dirname` or `None`.  Symbolic references aren't followed.
+    """
+    if not refname.startswith('refs/') or '..' in refname:
+        return None
+    try:
+        sha = open(os.path.join(dirname, refname)).read().rstrip()
+    except IOError:
+        pass
+    else:
+        if pattern_sha.match(sha):
+            return sha
+        return None
+    try:
+        for line in open(os.path.join(dirname, 'packed-refs')):
+            fields = line.split()
+            if 2 == len(fields) and refname == fields[1] \
+            and pattern_sha.match(fields[0]):
+                return fields[0]
+    except IOError:
+        pass
+    return None
@@ -2,6 +2,7 @@
 Utility functions.
 """
 
+import collections
 import json
 import os
 import os.path
@@ -158,8 +159,24 @@ class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, set):
             return list(o)
+        if isinstance(o, collections.Mapping):
+            return dict(o.iteritems())
         return super(JSONEncoder, self).default(o)
 
+def json_dump(o, f):
+    """
+    Write the same JSON as `json_dumps` to the file-like object `f` as it's
+    encoded, in pieces of about 64KB, rather than building it all in memory.
+    """
+    pieces, size = [], 0
+    for piece in JSONEncoder(indent=2, sort_keys=True).iterencode(o):
+        pieces.append(piece)
+        size += len(piece)
+        if 65536 <= size:
+            f.write(''.join(pieces))
+            pieces, size = [], 0
+    f.write(''.join(pieces))
+
 def json_dumps(o):
     return JSONEncoder(indent=2, sort_keys=True).encode(o)
 
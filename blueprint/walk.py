@@ -11,7 +11,9 @@ actual `Blueprint` objects and to construct Blueprint objects.
 import os.path
 import re
 
+import chunks
 import git
+import lazy
 import managers
 import util
 
@@ -29,6 +31,72 @@ def walk(b, **kwargs):
     walk_services(b, **kwargs)
 
 
+def events(b):
+    """
+    Generate the events of walking an entire blueprint, in the order `walk`
+    executes callbacks.  Each event is a tuple of the name of a callback
+    followed by its arguments, like `('file', pathname, f)`.  Resources are
+    enumerated only as events are consumed so consumers may stop early.
+    """
+    for generate in (source_events,
+                     file_events,
+                     package_events,
+                     service_events):
+        for event in generate(b):
+            yield event
+
+
+def _execute(events, callbacks):
+    """
+    Execute the callback named by each event with the event's arguments.
+    """
+    get = callbacks.get
+    for event in events:
+        callable = get(event[0])
+        if callable is not None:
+            callable(*event[1:])
+
+
+def combine(*visitors):
+    """
+    Return callbacks that call the callbacks by the same name in each of the
+    given `dict`s of callbacks in turn, so several visitors share one walk.
+    """
+    def fan_out(callables):
+        def callback(*args):
+            for callable in callables:
+                callable(*args)
+        return callback
+    names = set()
+    for visitor in visitors:
+        names.update(visitor.iterkeys())
+    return dict([(name, fan_out([visitor[name]
+                                 for visitor in visitors
+                                 if name in visitor]))
+                 for name in names])
+
+
+def _view(b, key, resources, build=lambda names: names):
+    """
+    Return a view of the given resources built by calling `build` with their
+    names in order.  Views are cached by `key` on `Blueprint` objects so
+    repeated walks don't sort again.  The `add_*` methods clear the cache and
+    views whose names no longer match the resources, as when resources are
+    replaced or removed directly, are rebuilt.  Naive structures aren't
+    cached.
+    """
+    views = getattr(b, '_views', None)
+    if views is None:
+        return build(sorted(resources.iterkeys()))
+    view = views.get(key)
+    if view is None or view[0] is not resources \
+    or len(view[1]) != len(resources) \
+    or not all(name in resources for name in view[1]):
+        names = sorted(resources.iterkeys())
+        view = views[key] = (resources, names, build(names))
+    return view[2]
+
+
 def walk_sources(b, **kwargs):
     """
     Walk a blueprint's source tarballs and execute callbacks.
@@ -38,36 +106,55 @@ def walk_sources(b, **kwargs):
     * `source(dirname, filename, gen_content, url):`
       Executed when a source tarball is enumerated.  Either `gen_content` or
       `url` will be `None`.  `gen_content`, when not `None`, is a callable
-      that will return the file's contents.
+      that will return an open file containing the tarball.
     * `after_sources():`
       Executed after source tarballs are enumerated.
     """
+    _execute(source_events(b), kwargs)
+
 
-    kwargs.get('before_sources', lambda *args: None)()
+def source_events(b):
+    """
+    Generate the events of walking a blueprint's source tarballs.
+    """
+    yield ('before_sources',)
 
     pattern = re.compile(r'^(?:file|ftp|https?)://', re.I)
-    callable = kwargs.get('source', lambda *args: None)
-    for dirname, filename in sorted(b.get('sources', {}).iteritems()):
+    sources = b.get('sources', {})
+    for dirname in _view(b, 'sources', sources):
+        filename = sources[dirname]
         if pattern.match(filename) is None:
-            def gen_content():
-
-                # It's a good thing `gen_content` is never called by the
-                # `Blueprint.__init__` callbacks, since this would always
-                # raise `AttributeError` on the fake blueprint structure
-                # used to initialize a real `Blueprint` object.
-                tree = git.tree(b._commit)
-
-                blob = git.blob(tree, filename)
-                return git.content(blob)
-            callable(dirname, filename, gen_content, None)
+            yield ('source',
+                   dirname,
+                   filename,
+                   _gen_content(b, filename),
+                   None)
         else:
             url = filename
             filename = os.path.basename(url)
             if '' == filename:
                 filename = 'blueprint-downloaded-tarball.tar.gz'
-            callable(dirname, filename, None, url)
+            yield ('source', dirname, filename, None, url)
+
+    yield ('after_sources',)
+
+
+def _gen_content(b, filename):
+    """
+    Return a callable that will return an open file containing the named
+    tarball.  It's bound here rather than in the loop in `source_events`
+    because events may be consumed after the loop has moved on.
+    """
+    def gen_content():
+
+        # It's a good thing `gen_content` is never called by the
+        # `Blueprint.__init__` callbacks, since this would always
+        # raise `AttributeError` on the fake blueprint structure
+        # used to initialize a real `Blueprint` object.
+        tree = git.tree(b._commit)
 
-    kwargs.get('before_sources', lambda *args: None)()
+        return chunks.cat_file(chunks.blobs(tree, filename))
+    return gen_content
 
 
 def walk_files(b, **kwargs):
@@ -81,29 +168,35 @@ def walk_files(b, **kwargs):
     * `after_files():`
       Executed after files are enumerated.
     """
+    _execute(file_events(b), kwargs)
 
-    kwargs.get('before_files', lambda *args: None)()
 
-    callable = kwargs.get('file', lambda *args: None)
-    for pathname, f in sorted(b.get('files', {}).iteritems()):
+def file_events(b):
+    """
+    Generate the events of walking a blueprint's files.
+    """
+    yield ('before_files',)
+
+    files = b.get('files', {})
+    for pathname in _view(b, 'files', files):
+        f = files[pathname]
 
         # AWS cfn-init templates may specify file content as JSON, which
         # must be converted to a string here, lest each frontend have to
-        # do so.
-        if 'content' in f and not isinstance(f['content'], basestring):
+        # do so.  Content yet to be read from its blob is always a string.
+        if not isinstance(f, lazy.File) and 'content' in f \
+        and not isinstance(f['content'], basestring):
             f['content'] = util.json_dumps(f['content'])
 
-        callable(pathname, f)
+        yield ('file', pathname, f)
 
-    kwargs.get('after_files', lambda *args: None)()
+    yield ('after_files',)
 
 
 def walk_packages(b, managername=None, **kwargs):
     """
-    Walk a package tree and execute callbacks along the way.  This is a bit
-    like iteration but can't match the iterator protocol due to the varying
-    argument lists given to each type of callback.  The available callbacks
-    are:
+    Walk a package tree and execute callbacks along the way.  The available
+    callbacks are:
 
     * `before_packages(manager):`
       Executed before a package manager's dependencies are enumerated.
@@ -112,47 +205,59 @@ def walk_packages(b, managername=None, **kwargs):
     * `after_packages(manager):`
       Executed after a package manager's dependencies are enumerated.
     """
+    _execute(package_events(b, managername), kwargs)
+
+
+def package_events(b, managername=None):
+    """
+    Generate the events of walking a package tree.
+    """
 
     # Walking begins with the system package managers, `apt`, `rpm`,
     # and `yum`.
     if managername is None:
-        walk_packages(b, 'apt', **kwargs)
-        walk_packages(b, 'rpm', **kwargs)
-        walk_packages(b, 'yum', **kwargs)
+        for managername in ('apt', 'rpm', 'yum'):
+            for event in package_events(b, managername):
+                yield event
         return
 
-    # Get the full manager from its name.
-    manager = managers.PackageManager(managername)
+    # Get the full manager from its name along with the names of its
+    # packages in order.
+    packages = b.get('packages', {}).get(managername, {})
+    manager, names = _view(b,
+                           ('packages', managername),
+                           packages,
+                           lambda names: (managers.PackageManager(managername),
+                                          names))
 
     # Give the manager a chance to setup for its dependencies.
-    kwargs.get('before_packages', lambda *args: None)(manager)
+    yield ('before_packages', manager)
 
     # Each package gets its chance to take action.  Note which packages
     # are themselves managers so they may be visited recursively later.
     next_managers = []
-    callable = kwargs.get('package', lambda *args: None)
-    for package, versions in sorted(b.get('packages',
-                                          {}).get(manager,
-                                                  {}).iteritems()):
+    for package in names:
+        versions = packages[package]
         if 0 == len(versions):
-            callable(manager, package, None)
+            yield ('package', manager, package, None)
         elif isinstance(versions, basestring):
-            callable(manager, package, versions)
+            yield ('package', manager, package, versions)
         else:
             for version in versions:
-                callable(manager, package, version)
+                yield ('package', manager, package, version)
         if managername != package and package in b.get('packages', {}):
             next_managers.append(package)
 
     # Give the manager a change to cleanup after itself.
-    kwargs.get('after_packages', lambda *args: None)(manager)
+    yield ('after_packages', manager)
 
     # Now recurse into each manager that was just installed.  Recursing
     # here is safer because there may be secondary dependencies that are
     # not expressed in the hierarchy (for example the `mysql2` gem
     # depends on `libmysqlclient-dev` in addition to its manager).
     for managername in next_managers:
-        walk_packages(b, managername, **kwargs)
+        for event in package_events(b, managername):
+            yield event
 
 
 def walk_services(b, managername=None, **kwargs):
@@ -165,28 +270,44 @@ def walk_services(b, managername=None, **kwargs):
       Executed when a service is enumerated.
     * `after_services(manager):`
       Executed after a service manager's dependencies are enumerated.
+
+    The callbacks of `walk_service_files`, `walk_service_packages`, and
+    `walk_service_sources` are executed after each service's.
+    """
+    _execute(service_events(b, managername), kwargs)
+
+
+def service_events(b, managername=None):
+    """
+    Generate the events of walking a blueprint's services.
     """
 
     # Unless otherwise specified, walk all service managers.
+    services = b.get('services', {})
     if managername is None:
-        for managername in sorted(b.get('services', {}).iterkeys()):
-            walk_services(b, managername, **kwargs)
+        for managername in _view(b, 'services', services):
+            for event in service_events(b, managername):
+                yield event
         return
 
-    manager = managers.ServiceManager(managername)
+    services = services.get(managername, {})
+    manager, names = _view(b,
+                           ('services', managername),
+                           services,
+                           lambda names: (managers.ServiceManager(managername),
+                                          names))
 
-    kwargs.get('before_services', lambda *args: None)(manager)
+    yield ('before_services', manager)
 
-    callable = kwargs.get('service', lambda *args: None)
-    for service, deps in sorted(b.get('services',
-                                      {}).get(manager,
-                                              {}).iteritems()):
-        callable(manager, service)
-        walk_service_files(b, manager, service, **kwargs)
-        walk_service_packages(b, manager, service, **kwargs)
-        walk_service_sources(b, manager, service, **kwargs)
+    for service in names:
+        yield ('service', manager, service)
+        for generate in (service_file_events,
+                         service_package_events,
+                         service_source_events):
+            for event in generate(b, manager, service):
+                yield event
 
-    kwargs.get('after_services', lambda *args: None)(manager)
+    yield ('after_services', manager)
 
 
 def walk_service_files(b, manager, servicename, **kwargs):
@@ -196,12 +317,18 @@ def walk_service_files(b, manager, servicename, **kwargs):
     * `service_file(manager, servicename, pathname):`
       Executed when a file service dependency is enumerated.
     """
+    _execute(service_file_events(b, manager, servicename), kwargs)
+
+
+def service_file_events(b, manager, servicename):
+    """
+    Generate the events of walking a service's file dependencies.
+    """
     deps = b.get('services', {}).get(manager, {}).get(servicename, {})
     if 'files' not in deps:
         return
-    callable = kwargs.get('service_file', lambda *args: None)
     for pathname in list(deps['files']):
-        callable(manager, servicename, pathname)
+        yield ('service_file', manager, servicename, pathname)
 
 
 def walk_service_packages(b, manager, servicename, **kwargs):
@@ -214,13 +341,23 @@ def walk_service_packages(b, manager, servicename, **kwargs):
                        package):`
       Executed when a file service dependency is enumerated.
     """
+    _execute(service_package_events(b, manager, servicename), kwargs)
+
+
+def service_package_events(b, manager, servicename):
+    """
+    Generate the events of walking a service's package dependencies.
+    """
     deps = b.get('services', {}).get(manager, {}).get(servicename, {})
     if 'packages' not in deps:
         return
-    callable = kwargs.get('service_package', lambda *args: None)
     for package_managername, packages in deps['packages'].iteritems():
         for package in packages:
-            callable(manager, servicename, package_managername, package)
+            yield ('service_package',
+                   manager,
+                   servicename,
+                   package_managername,
+                   package)
 
 
 def walk_service_sources(b, manager, servicename, **kwargs):
@@ -230,9 +367,15 @@ def walk_service_sources(b, manager, servicename, **kwargs):
     * `service_source(manager, servicename, dirname):`
       Executed when a source tarball service dependency is enumerated.
     """
+    _execute(service_source_events(b, manager, servicename), kwargs)
+
+
+def service_source_events(b, manager, servicename):
+    """
+    Generate the events of walking a service's source tarball dependencies.
+    """
     deps = b.get('services', {}).get(manager, {}).get(servicename, {})
     if 'sources' not in deps:
         return
-    callable = kwargs.get('service_source', lambda *args: None)
     for dirname in list(deps['sources']):
-        callable(manager, servicename, dirname)
+        yield ('service_source', manager, servicename, dirname)
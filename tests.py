@@ -1,8 +1,26 @@
 from flask.testing import FlaskClient
+import copy
 import json
+import os
 import os.path
+import shutil
+from StringIO import StringIO
 import sys
+import tarfile
+import tempfile
 
+from nose.tools import with_setup
+
+from blueprint import Blueprint
+from blueprint import cache
+from blueprint import cfg
+from blueprint import chunks
+from blueprint import compact
+from blueprint import compare
+from blueprint import git
+from blueprint import lazy
+from blueprint import objects
+from blueprint import walk
 from blueprint.io.server import app
 
 SECRET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_-'
@@ -104,6 +122,13 @@ def test_PUT_tarball():
                      data=open(pathname).read())
     assert 202 == response.status_code
 
+def test_PUT_tarball_gz_invalid_data():
+    test_PUT_blueprint_sources()
+    response = c.put('/{0}/{1}/{2}.tar.gz'.format(SECRET, NAME, SHA),
+                     content_type='application/x-gzip',
+                     data=open(pathname).read())
+    assert 400 == response.status_code
+
 def test_GET_blueprint_invalid():
     test_PUT_blueprint_empty()
     response = c.get('/{0}/{1}'.format(SECRET, 'four-oh-four'))
@@ -145,7 +170,702 @@ def test_GET_tarball_invalid():
     response = c.get('/{0}/{1}/{2}.tar'.format(SECRET, NAME, '0' * 40))
     assert 404 == response.status_code
 
+def test_GET_tarball_gz_invalid():
+    test_PUT_blueprint_empty()
+    response = c.get('/{0}/{1}/{2}.tar.gz'.format(SECRET, NAME, '0' * 40))
+    assert 404 == response.status_code
+
 def test_GET_tarball():
     test_PUT_tarball()
     response = c.get('/{0}/{1}/{2}.tar'.format(SECRET, NAME, SHA))
     assert 301 == response.status_code
+
+def setup_repo():
+    """
+    Point Blueprint at a new, empty Git repository in a temporary home
+    directory and work in another temporary directory.
+    """
+    global saved_home, saved_cwd
+    saved_home, saved_cwd = os.environ['HOME'], os.getcwd()
+    os.environ['HOME'] = tempfile.mkdtemp()
+    os.chdir(tempfile.mkdtemp())
+    git.init()
+    git.git('config', 'user.name', 'Blueprint')
+    git.git('config', 'user.email', 'blueprint@example.com')
+
+def teardown_repo():
+    shutil.rmtree(os.environ['HOME'])
+    shutil.rmtree(os.getcwd())
+    os.environ['HOME'] = saved_home
+    os.chdir(saved_cwd)
+
+def write_tarball(filename, count, large=0):
+    tar = tarfile.open(filename, 'w')
+    for i in range(count):
+        data = '{0}\n'.format(i) * (i * 97 % 5000)
+        tarinfo = tarfile.TarInfo('dir/file{0}'.format(i))
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, StringIO(data))
+    if large:
+        tarinfo = tarfile.TarInfo('dir/large')
+        tarinfo.size = large
+        tar.addfile(tarinfo, StringIO('.' * large))
+    tar.close()
+
+@with_setup(setup_repo, teardown_repo)
+def test_chunks_split():
+    write_tarball('test.tar', 256, 2 * chunks.MAX + 1)
+    offset = 0
+    for start, length in chunks.split('test.tar'):
+        assert offset == start
+        assert 0 < length
+        offset += length
+    assert os.path.getsize('test.tar') == offset
+    assert 2 < len(list(chunks.split('test.tar')))
+
+@with_setup(setup_repo, teardown_repo)
+def test_chunks_round_trip():
+    write_tarball('test.tar', 256, 2 * chunks.MAX + 1)
+    content = open('test.tar', 'rb').read()
+    shas = git.hash_objects(chunks.write('test.tar'))
+    assert 2 < len(shas)
+    assert content == chunks.cat_file(shas).read()
+    assert content == ''.join(chunks.stream(shas))
+    chunks.cat_file(shas, 'test2.tar')
+    assert content == open('test2.tar', 'rb').read()
+
+@with_setup(setup_repo, teardown_repo)
+def test_chunks_round_trip_not_tar():
+    open('test.tar', 'wb').write('not a tarball\n' * 1000)
+    content = open('test.tar', 'rb').read()
+    shas = git.hash_objects(chunks.write('test.tar'))
+    assert 1 == len(shas)
+    assert content == chunks.cat_file(shas).read()
+
+@with_setup(setup_repo, teardown_repo)
+def test_chunks_blobs():
+    shas = [git.hash_object(str(i)) for i in range(4)]
+    git.update_index([('100644', shas[0], 'whole.tar'),
+                      ('100644', shas[1], 'split.tar.chunks/00000001'),
+                      ('100644', shas[2], 'split.tar.chunks/00000000'),
+                      ('100644', shas[3], 'files/etc/motd')])
+    tree = git.write_tree()
+    assert [shas[0]] == chunks.blobs(tree, 'whole.tar')
+    assert shas[2:0:-1] == chunks.blobs(tree, 'split.tar')
+    assert chunks.blobs(tree, 'missing.tar') is None
+    assert chunks.blobs(tree, 'files') is None
+    assert tree not in git._trees
+    assert git.ls_level(tree)['files'][1] not in git._levels
+
+def commit_similar_blobs():
+    """
+    Commit blobs similar enough to be stored as deltas when packed and
+    return the SHAs of every object in the commit.
+    """
+    base = ''.join(['line {0}\n'.format(i) for i in range(2000)])
+    shas = []
+    entries = []
+    for i in range(8):
+        content = base.replace('line {0}\n'.format(i * 100), 'changed\n')
+        sha = git.hash_object(content)
+        shas.append(sha)
+        entries.append(('100644', sha, 'dir/file{0}'.format(i)))
+    git.update_index(entries)
+    tree = git.write_tree()
+    commit = git.commit_tree(tree, 'test')
+    git.git('update-ref', 'refs/heads/test', commit)
+    status, stdout = git.git('ls-tree', '-r', '-t', tree)
+    shas.extend([line.split()[2] for line in stdout.splitlines()])
+    return set(shas + [tree, commit])
+
+def assert_objects(shas):
+    for sha in shas:
+        type = git.git('cat-file', '-t', sha)[1].rstrip()
+        content = git.git('cat-file', type, sha)[1]
+        assert (type, content) == objects.read(git.repo(), sha)
+        pieces = objects.stream(git.repo(), sha)
+        if pieces is not None:
+            assert content == ''.join(pieces)
+
+def packed_types(shas):
+    types = set()
+    for pack in objects.packs(git.repo()):
+        for sha in shas:
+            offset = pack.offset(sha.decode('hex'))
+            if offset is not None:
+                types.add(pack.header(offset)[0])
+    return types
+
+@with_setup(setup_repo, teardown_repo)
+def test_objects_loose():
+    shas = commit_similar_blobs()
+    assert 0 == len(objects.packs(git.repo()))
+    assert_objects(shas)
+
+@with_setup(setup_repo, teardown_repo)
+def test_objects_ofs_delta():
+    shas = commit_similar_blobs()
+    git.git('-c', 'repack.useDeltaBaseOffset=true',
+            'repack', '-a', '-d', '-q')
+    git.git('prune-packed')
+    assert objects.OFS_DELTA in packed_types(shas)
+    assert_objects(shas)
+
+@with_setup(setup_repo, teardown_repo)
+def test_objects_ref_delta():
+    shas = commit_similar_blobs()
+    git.git('-c', 'repack.useDeltaBaseOffset=false',
+            'repack', '-a', '-d', '-q')
+    git.git('prune-packed')
+    assert objects.REF_DELTA in packed_types(shas)
+    assert_objects(shas)
+
+@with_setup(setup_repo, teardown_repo)
+def test_objects_missing():
+    assert objects.read(git.repo(), '0' * 40) is None
+    assert objects.stream(git.repo(), '0' * 40) is None
+    assert objects.read(git.repo(), 'invalid') is None
+
+@with_setup(setup_repo, teardown_repo)
+def test_objects_ref():
+    assert objects.ref(git.repo(), 'refs/heads/test') is None
+    commit_similar_blobs()
+    commit = git.git('rev-parse', 'refs/heads/test')[1].rstrip()
+    assert commit == objects.ref(git.repo(), 'refs/heads/test')
+    git.git('pack-refs', '--all')
+    assert not os.path.exists(os.path.join(git.repo(), 'refs/heads/test'))
+    assert commit == objects.ref(git.repo(), 'refs/heads/test')
+    assert objects.ref(git.repo(), 'refs/heads/missing') is None
+
+@with_setup(setup_repo, teardown_repo)
+def test_cache_round_trip():
+    data = {'files': {'/etc/motd': {'content': u'Hello\n'}},
+            'packages': {'apt': {'vim': ['2:7.3']}}}
+    assert cache.load('0' * 40) is None
+    cache.store('0' * 40, data)
+    assert data == cache.load('0' * 40)
+
+@with_setup(setup_repo, teardown_repo)
+def test_cache_version():
+    cache.store('0' * 40, {})
+    version = cache.VERSION
+    cache.VERSION += 1
+    try:
+        assert cache.load('0' * 40) is None
+    finally:
+        cache.VERSION = version
+    assert {} == cache.load('0' * 40)
+
+@with_setup(setup_repo, teardown_repo)
+def test_cache_prune():
+    b = Blueprint('test')
+    b.add_file('/etc/motd', content='Hello\n', encoding='plain')
+    b.commit()
+    commit = b._commit
+    Blueprint.checkout('test')
+    assert cache.load(commit) is not None
+    b.add_package('apt', 'vim', '2:7.3')
+    b.commit()
+    assert cache.load(commit) is None
+    Blueprint.checkout('test')
+    assert cache.load(b._commit) is not None
+    Blueprint.destroy('test')
+    assert [] == os.listdir(cache.dirname())
+
+@with_setup(setup_repo, teardown_repo)
+def test_git_blob():
+    shas = [git.hash_object(str(i)) for i in range(3)]
+    git.update_index([('100644', shas[0], 'summary.json'),
+                      ('100644', shas[1], 'files/etc/motd'),
+                      ('100644', shas[2], 'files/etc/hosts')])
+    tree = git.write_tree()
+    assert shas[0] == git.blob(tree, 'summary.json')
+    assert shas[1] == git.blob(tree, 'files/etc/motd')
+    assert git.blob(tree, 'files/etc') is None
+    assert git.blob(tree, 'files/etc/missing') is None
+    assert git.blob(tree, 'summary.json/missing') is None
+    assert tree not in git._trees
+    git.ls_tree(tree)
+    assert shas[2] == git.blob(tree, 'files/etc/hosts')
+
+@with_setup(setup_repo, teardown_repo)
+def test_iter_summaries():
+    b = Blueprint('test')
+    b.add_file('/etc/motd', content='Hello\n', encoding='plain')
+    b.add_package('apt', 'vim', '2:7.3')
+    b.commit('message')
+    summary, = Blueprint.iter_summaries()
+    assert 'test' == summary['name']
+    assert b._commit == summary['commit']
+    assert 'message' == summary['message']
+    assert 1 == summary['files']
+    assert 1 == summary['packages']
+    assert 0 == summary['services']
+
+def plain_packages(b):
+    return dict([(manager, dict([(package, sorted(versions))
+                                 for package, versions
+                                 in packages.iteritems()]))
+                 for manager, packages in b.get('packages', {}).iteritems()
+                 if 0 < len(packages)])
+
+def test_sub_files():
+    b1 = Blueprint('b1')
+    b1.add_file('/etc/same', content='same\n', encoding='plain')
+    b1.add_file('/etc/differ', content='one\n', encoding='plain')
+    b1.add_file('/etc/only', content='only\n', encoding='plain')
+    b2 = Blueprint('b2')
+    b2.add_file('/etc/same', content='same\n', encoding='plain')
+    b2.add_file('/etc/differ', content='two\n', encoding='plain')
+    b2.add_file('/etc/other', content='other\n', encoding='plain')
+    b3 = copy.deepcopy(b1)
+    b = b1 - b2
+    assert ['/etc/differ', '/etc/only'] == sorted(b.files.keys())
+    assert b1.files['/etc/differ'] == b.files['/etc/differ']
+    assert b3 == b1
+
+def test_sub_packages():
+    b1 = Blueprint('b1')
+    b1.add_package('apt', 'same', '1')
+    b1.add_package('apt', 'differ', '1')
+    b1.add_package('apt', 'versions', '1')
+    b1.add_package('apt', 'versions', '2')
+    b1.add_package('yum', 'only', '1')
+    b2 = Blueprint('b2')
+    b2.add_package('apt', 'same', '1')
+    b2.add_package('apt', 'differ', '2')
+    b2.add_package('apt', 'versions', '1')
+    b3 = copy.deepcopy(b1)
+    b = b1 - b2
+    assert {'apt': {'differ': ['1'], 'versions': ['2']},
+            'yum': {'only': ['1']}} == plain_packages(b)
+    assert b3 == b1
+
+def test_sub_managers():
+    b1 = Blueprint('b1')
+    b1.add_package('apt', 'python-pip', '1')
+    b1.add_package('python-pip', 'flask', '1')
+    b1.add_package('python-pip', 'django', '1')
+    b2 = Blueprint('b2')
+    b2.add_package('apt', 'python-pip', '1')
+    b2.add_package('python-pip', 'flask', '1')
+    assert {'apt': {'python-pip': ['1']},
+            'python-pip': {'django': ['1']}} == plain_packages(b1 - b2)
+    b2.add_package('python-pip', 'django', '1')
+    assert {} == plain_packages(b1 - b2)
+
+def test_sub_missing_manager():
+
+    # Packages whose manager the subtrahend doesn't install aren't reached
+    # by its walk, so they're kept.
+    b1 = Blueprint('b1')
+    b1.add_package('apt', 'python-pip', '1')
+    b1.add_package('python-pip', 'flask', '1')
+    b2 = Blueprint('b2')
+    b2.add_package('python-pip', 'flask', '1')
+    assert {'apt': {'python-pip': ['1']},
+            'python-pip': {'flask': ['1']}} == plain_packages(b1 - b2)
+
+    # Packages whose manager the minuend doesn't install are removed.
+    b1 = Blueprint('b1')
+    b1.add_package('python-pip', 'flask', '1')
+    b1.add_package('python-pip', 'django', '1')
+    b2 = Blueprint('b2')
+    b2.add_package('apt', 'python-pip', '1')
+    b2.add_package('python-pip', 'flask', '1')
+    assert {'python-pip': {'django': ['1']}} == plain_packages(b1 - b2)
+    b2.add_package('python-pip', 'django', '1')
+    assert {} == plain_packages(b1 - b2)
+
+def test_sub_special_dependencies():
+    b1 = Blueprint('b1')
+    for package in ('ruby1.8', 'ruby1.8-dev', 'rubygems1.8'):
+        b1.add_package('apt', package, '1')
+    b1.add_package('rubygems1.8', 'rails', '1')
+    b2 = Blueprint('b2')
+    for package in ('ruby1.8', 'ruby1.8-dev', 'rubygems1.8'):
+        b2.add_package('apt', package, '1')
+    b2.add_package('rubygems1.8', 'sinatra', '1')
+    assert {'apt': {'ruby1.8': ['1'],
+                    'ruby1.8-dev': ['1'],
+                    'rubygems1.8': ['1']},
+            'rubygems1.8': {'rails': ['1']}} == plain_packages(b1 - b2)
+
+def test_sub_services_sources():
+    b1 = Blueprint('b1')
+    b1.add_service('sysvinit', 'same')
+    b1.add_service('sysvinit', 'differ')
+    b1.add_service_file('sysvinit', 'differ', '/etc/differ')
+    b1.add_source('/usr/local', 'same.tar')
+    b1.add_source('/opt', 'differ.tar')
+    b2 = Blueprint('b2')
+    b2.add_service('sysvinit', 'same')
+    b2.add_service('sysvinit', 'differ')
+    b2.add_source('/usr/local', 'same.tar')
+    b2.add_source('/opt', 'other.tar')
+    b = b1 - b2
+    assert ['differ'] == b.services['sysvinit'].keys()
+    assert {'/opt': 'differ.tar'} == dict(b.sources)
+
+def test_sub_independent():
+    b1 = Blueprint('b1')
+    for package in ('ruby1.8', 'rubygems1.8'):
+        b1.add_package('apt', package, '1')
+    b1.add_package('apt', 'vim', '1')
+    b1.add_package('rubygems1.8', 'rails', '1')
+    b1.add_service('sysvinit', 'ssh')
+    b1.add_service_file('sysvinit', 'ssh', '/etc/ssh')
+    b1.add_service_package('sysvinit', 'ssh', 'apt', 'openssh-server')
+    b1.add_service_source('sysvinit', 'ssh', '/usr/local')
+    b2 = Blueprint('b2')
+    for package in ('ruby1.8', 'rubygems1.8'):
+        b2.add_package('apt', package, '1')
+    b2.add_package('rubygems1.8', 'sinatra', '1')
+    b3 = copy.deepcopy(b1)
+    b = b1 - b2
+
+    # `ruby1.8` is added back by the third pass and `vim` is kept.
+    b.add_package('apt', 'ruby1.8', '2')
+    b.add_package('apt', 'vim', '2')
+    b.add_package('rubygems1.8', 'rails', '2')
+    b.add_service_file('sysvinit', 'ssh', '/etc/default/ssh')
+    b.add_service_package('sysvinit', 'ssh', 'apt', 'ssh')
+    b.add_service_source('sysvinit', 'ssh', '/opt')
+    assert ['1', '2'] == sorted(b.packages['apt']['ruby1.8'])
+    assert b3 == b1
+
+def comparison():
+    blueprints = [Blueprint('b0'), Blueprint('b1'), Blueprint('b2')]
+    for b, content, version in zip(blueprints, 'xxy', '121'):
+        b.add_file('/etc/a', content=content, encoding='plain')
+        b.add_file('/etc/b', content='same', encoding='plain')
+        b.add_package('apt', 'vim', version)
+    blueprints[2].add_service('sysvinit', 'ssh')
+    return compare.Comparison(blueprints)
+
+def test_compare_differences():
+    c = comparison()
+    resources = [resource for resource, variants in c.differences()]
+    assert [('file', '/etc/a'),
+            ('package', 'apt', 'vim'),
+            ('service', 'sysvinit', 'ssh')] == resources
+
+def test_compare_row():
+    c = comparison()
+    rows = [c.row(variants) for resource, variants in c.differences()]
+    assert ['..*', '.*.', '..+'] == rows
+    rows = [c.row(variants, 2) for resource, variants in c.differences()]
+    assert ['**.', '.*.', '--.'] == rows
+
+def test_compare_row_tie():
+    blueprints = [Blueprint('b0'), Blueprint('b1')]
+    for b, content in zip(blueprints, 'xy'):
+        b.add_file('/etc/a', content=content, encoding='plain')
+    c = compare.Comparison(blueprints)
+    assert ['.*'] == [c.row(variants)
+                      for resource, variants in c.differences()]
+
+def test_compare_summary():
+    c = comparison()
+    assert [{'source': 0, 'file': 0, 'package': 0, 'service': 0},
+            {'source': 0, 'file': 0, 'package': 1, 'service': 0},
+            {'source': 0, 'file': 1, 'package': 0, 'service': 1}] \
+        == c.summary()
+    assert [{'source': 0, 'file': 1, 'package': 0, 'service': 1},
+            {'source': 0, 'file': 1, 'package': 1, 'service': 1},
+            {'source': 0, 'file': 0, 'package': 0, 'service': 0}] \
+        == c.summary(2)
+
+@with_setup(setup_repo, teardown_repo)
+def test_compare_lazy():
+    metadata = {'encoding': 'plain', 'mode': '100644'}
+    blueprints = [Blueprint('b0'), Blueprint('b1'), Blueprint('b2')]
+    blueprints[0].add_file('/etc/motd', content=u'Hello\n', **metadata)
+    blueprints[1].files['/etc/motd'] = lazy.File(git.hash_object('Hello\n'),
+                                                 metadata)
+    blueprints[2].files['/etc/motd'] = lazy.File(git.hash_object('Bye\n'),
+                                                 metadata)
+    c = compare.Comparison(blueprints)
+    assert ['..*'] == [c.row(variants)
+                       for resource, variants in c.differences()]
+    for b in blueprints[1:]:
+        assert b.files['/etc/motd'].blob is not None
+
+def test_intersect():
+    c = comparison()
+    b = c.intersect('intersection')
+    assert ['/etc/b'] == b.files.keys()
+    assert {'apt': {'vim': []}} == plain_packages(b)
+    assert 0 == len(b.get('services', {}))
+    b = c.intersect('intersection', 2)
+    assert 'x' == b.files['/etc/a']['content']
+    assert {'apt': {'vim': ['1']}} == plain_packages(b)
+
+def test_intersect_quorum_variants():
+    blueprints = [Blueprint('b{0}'.format(i)) for i in range(4)]
+    for b, content in zip(blueprints, 'zyyx'):
+        b.add_file('/etc/a', content=content, encoding='plain')
+    for b, content in zip(blueprints, 'zyxw'):
+        b.add_file('/etc/b', content=content, encoding='plain')
+    c = compare.Comparison(blueprints)
+    for quorum in (1, 2):
+        b = c.intersect('intersection', quorum)
+        assert 'y' == b.files['/etc/a']['content']
+    b = c.intersect('intersection', 1)
+    assert 'z' == b.files['/etc/b']['content']
+    b = c.intersect('intersection', 2)
+    assert '/etc/b' not in b.files
+
+def test_intersect_managers():
+    blueprints = [Blueprint('b0'), Blueprint('b1')]
+    for b, manager in zip(blueprints, ('apt', 'yum')):
+        b.add_package(manager, 'python-pip', '1')
+        b.add_package('python-pip', 'flask', '1')
+    b = compare.Comparison(blueprints).intersect('intersection', 2)
+    assert {} == plain_packages(b)
+    b = compare.Comparison(blueprints).intersect('intersection', 1)
+    assert {'apt': {'python-pip': ['1']},
+            'yum': {'python-pip': ['1']},
+            'python-pip': {'flask': ['1']}} == plain_packages(b)
+
+def test_validate_round_trip():
+    b = Blueprint.loads('{"packages": {"apt": {"vim": []}}}')
+    b.add_package('apt', 'any', None)
+    b2 = Blueprint.loads(b.dumps(), validate=True)
+    assert b.dumps() == b2.dumps()
+    b2 = Blueprint.loads(example().dumps(), validate=True)
+    assert example().dumps() == b2.dumps()
+    try:
+        Blueprint.validate({'packages': {'apt': {'vim': [None, 1]}}})
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_validate_files():
+    Blueprint.validate({'files': {'/etc/a': {
+        'content': {'key': 'value'},
+        'authentication': {'type': 'S3'},
+        'context': {'key': 'value'},
+        'mode': '100644',
+    }}})
+    for f in ({}, {'mode': '100644'}, {'content': '', 'owner': 0}):
+        try:
+            Blueprint.validate({'files': {'/etc/a': f}})
+        except ValueError:
+            pass
+        else:
+            assert False, f
+
+@with_setup(setup_repo, teardown_repo)
+def test_git_special_pathnames():
+    pathnames = ['tab\tname', 'newline\nname', 'quote"name', '"quoted"',
+                 'backslash\\name', 'return\r', 'plain']
+    for pathname in pathnames:
+        open(pathname, 'w').write(pathname)
+    shas = git.hash_objects(pathnames)
+    assert [git.hash_object(pathname) for pathname in pathnames] == shas
+    git.update_index([('100644', sha, 'files/' + pathname)
+                      for sha, pathname in zip(shas, pathnames)])
+    tree = git.write_tree()
+    for sha, pathname in zip(shas, pathnames):
+        assert sha == git.blob(tree, 'files/' + pathname)
+
+@with_setup(setup_repo, teardown_repo)
+def test_lazy_file():
+    inline = {'content': u'Hello\n',
+              'encoding': 'plain',
+              'group': 'root',
+              'mode': '100644',
+              'owner': 'root'}
+    metadata = dict(inline)
+    del metadata['content']
+    sha = git.hash_object('Hello\n')
+    f = lazy.File(sha, metadata)
+    assert 'content' in f
+    assert 5 == len(f)
+    assert sorted(inline.keys()) == sorted(f.keys())
+    assert 'root' == f['owner']
+    assert sha == f.blob
+    assert lazy.File(sha, metadata) == f
+    assert sha == f.blob
+    assert inline == f
+    assert f.blob is None
+    f = lazy.File(sha, metadata)
+    assert u'Hello\n' == f['content']
+    assert f.blob is None
+    assert inline == f.copy()
+
+@with_setup(setup_repo, teardown_repo)
+def test_lazy_commit():
+    b = Blueprint('test')
+    b.add_file('/etc/motd', content=u'Hello\n', encoding='plain')
+    blobs = cfg.get('files', 'blobs')
+    cfg.set('files', 'blobs', 'true')
+    try:
+        b.commit()
+    finally:
+        cfg.set('files', 'blobs', blobs)
+    tree = git.tree(b._commit)
+    assert git.blob(tree, 'files/etc/motd') is not None
+    data = json.loads(git.content(git.blob(tree, 'blueprint.json')))
+    assert 'blob' in data['files']['/etc/motd']
+    for i in range(2):
+        b2 = Blueprint.checkout('test')
+        f = b2.files['/etc/motd']
+        assert isinstance(f, lazy.File) and f.blob is not None
+        assert b.files == b2.files
+        assert b.dumps() == b2.dumps()
+
+def example():
+    b = Blueprint('example')
+    b.add_file('/etc/motd', content=u'Hello\n', encoding='plain',
+               group='root', mode='100644', owner='root')
+    b.add_file('/etc/template', template='{{NAME}}\n', data='NAME=x\n',
+               encoding='plain', group='root', mode='100644', owner='root')
+    b.files['/etc/cfn'] = {'content': u'{}',
+                           'context': {'key': 'value'},
+                           'encoding': 'plain',
+                           'group': 'root',
+                           'mode': '100644',
+                           'owner': 'root'}
+    b.add_package('apt', 'python-pip', '1.0-1')
+    b.add_package('apt', 'vim', '2:7.3')
+    b.add_package('apt', 'vim', '2:7.4')
+    b.add_package('python-pip', 'flask', '0.9')
+    b.add_package('yum', 'any', None)
+    b.add_service('sysvinit', 'ssh')
+    b.add_service_file('sysvinit', 'ssh', '/etc/motd')
+    b.add_service_package('sysvinit', 'ssh', 'apt', 'vim')
+    b.add_service_source('sysvinit', 'ssh', '/usr/local')
+    b.add_source('/usr/local', 'usr-local.tar')
+    return b
+
+@with_setup(setup_repo, teardown_repo)
+def test_compact():
+    b = example()
+    b2 = copy.deepcopy(b)
+    b2.compact()
+    assert isinstance(b2.files['/etc/motd'], compact.File)
+    assert isinstance(b2.packages['apt']['vim'], compact.Versions)
+    assert b.dumps() == b2.dumps()
+    assert b.sh().dumps() == b2.sh().dumps()
+    assert (b - b).dumps() == (b2 - b2).dumps()
+    assert b2.files['/etc/motd'] == b.files['/etc/motd']
+    assert 'value' == b2.files['/etc/cfn']['context']['key']
+
+def test_compact_intern():
+    b1, b2 = example(), example()
+    b1.compact()
+    b2.compact()
+    assert b1.files['/etc/motd']['owner'] is b2.files['/etc/motd']['owner']
+    assert list(b1.packages['apt']['vim'])[0] \
+        is list(b2.packages['apt']['vim'])[0]
+
+def walked(b):
+    events = []
+    b.walk(source=lambda dirname, *args: events.append(dirname),
+           file=lambda pathname, f: events.append(pathname),
+           package=lambda manager, package, version: events.append(package),
+           service=lambda manager, service: events.append(service))
+    return events
+
+def test_views():
+    b = example()
+    events = walked(b)
+    names = b._views['files'][2]
+    assert events == walked(b)
+    assert names is b._views['files'][2]
+    b.add_file('/etc/added', content='', encoding='plain')
+    b.add_package('apt', 'added', '1')
+    b.add_service('sysvinit', 'added')
+    b.add_source('/opt', 'opt.tar')
+    assert 0 == len(b._views)
+    events = walked(b)
+    for name in ('/etc/added', '/opt'):
+        assert name in events
+    assert 2 == events.count('added')
+
+def test_views_replaced():
+    b = example()
+    walked(b)
+    del b.files['/etc/cfn']
+    assert '/etc/cfn' not in walked(b)
+    b['files'] = dict(b.files)
+    b['files']['/etc/other'] = b['files'].pop('/etc/motd')
+    events = walked(b)
+    assert '/etc/other' in events and '/etc/motd' not in events
+
+    # Replacing a resource directly by another keeps the number of them.
+    del b.packages['apt']['vim']
+    b.packages['apt']['emacs'] = set(['1'])
+    events = walked(b)
+    assert 'emacs' in events and 'vim' not in events
+
+def test_views_compact():
+    b = example()
+    walked(b)
+    b.compact()
+    assert 0 == len(b._views)
+    walked(b)
+    assert b._views['files'][0] is b.files
+
+CALLBACKS = ('before_sources', 'source', 'after_sources',
+             'before_files', 'file', 'after_files',
+             'before_packages', 'package', 'after_packages',
+             'before_services', 'service', 'after_services',
+             'service_file', 'service_package', 'service_source')
+
+def comparable(event):
+    """
+    Return the event with `gen_content`, which is a new function each walk,
+    replaced by whether there is one.
+    """
+    if 'source' == event[0]:
+        return event[:3] + (event[3] is not None,) + event[4:]
+    return event
+
+def test_events():
+    b = example()
+    b.add_source('/opt', 'http://example.com/opt.tar.gz')
+    callbacks = []
+    walk.walk(b, **dict([(name, (lambda name: lambda *args:
+                                 callbacks.append((name,) + args))(name))
+                         for name in CALLBACKS]))
+    callbacks = [comparable(event) for event in callbacks]
+    assert callbacks == [comparable(event) for event in walk.events(b)]
+    assert callbacks == [comparable(event) for event in b.events()]
+    assert ('before_sources',) == callbacks[0]
+    assert ('after_services', 'sysvinit') == callbacks[-1]
+
+def test_events_lazy():
+    b = example()
+    events = walk.file_events(b)
+    assert ('before_files',) == events.next()
+    assert 'file' == events.next()[0]
+    b.add_file('/etc/added', content='', encoding='plain')
+    events.close()
+    assert ['/etc/added', '/etc/cfn', '/etc/motd', '/etc/template'] \
+        == [event[1] for event in walk.file_events(b) if 'file' == event[0]]
+
+def test_combine():
+    calls = []
+    callbacks = walk.combine(
+        {'file': lambda pathname, f: calls.append(('first', pathname))},
+        {'file': lambda pathname, f: calls.append(('second', pathname)),
+         'service': lambda manager, service: calls.append(service)})
+    assert ['file', 'service'] == sorted(callbacks.keys())
+    walk.walk(example(), **callbacks)
+    assert [('first', '/etc/cfn'), ('second', '/etc/cfn'),
+            ('first', '/etc/motd'), ('second', '/etc/motd'),
+            ('first', '/etc/template'), ('second', '/etc/template'),
+            'ssh'] == calls
+
+@with_setup(setup_repo, teardown_repo)
+def test_generate():
+    b = example()
+    del b['sources']
+    names = ['sh', 'puppet', 'chef', 'blueprint_rules', 'cfn']
+    generated = copy.deepcopy(b).generate(names)
+    assert [getattr(copy.deepcopy(b), name)().dumps() for name in names] \
+        == [g.dumps() for g in generated]